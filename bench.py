@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Benchmarks for the WFD source. These run the source and the reference
+sink (see sink.py) on localhost, so no Wi-Fi hardware is needed."""
+
+import gi
+
+gi.require_version('Gst', '1.0')
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+from gi.repository import GLib
+from gi.repository import Gst
+
+
+def iterate_until(condition, timeout):
+    """Run the default main context until condition() is true. Returns False
+    on timeout."""
+    context = GLib.MainContext.default()
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        context.iteration(False) or time.sleep(0.001)
+    return True
+
+
+def print_table(title, rows):
+    print(title)
+    for name, values in rows:
+        if not values:
+            print('  %-32s %s' % (name, 'n/a'))
+            continue
+        print('  %-32s median %8.1f ms  min %8.1f ms  max %8.1f ms' % (
+            name, statistics.median(values), min(values), max(values)))
+
+
+def bench_negotiation(args):
+    """Time from TCP accept to the first RTP packet, broken down into the
+    individual M-messages."""
+    from rtsp import WFDServer
+    from sink import WFDSink
+
+    server = WFDServer(port=args.port)
+    server.attach()
+    clients = []
+    server.connect('client-connected', lambda server, client: clients.append(client))
+
+    steps = {}
+    order = []
+    first_frame = []
+    for i in range(args.iterations):
+        sink = WFDSink(rtp_port=args.rtp_port)
+        sink.connect('127.0.0.1', args.port)
+        if not iterate_until(lambda: sink.first_frame is not None, args.timeout):
+            print('WARNING: Iteration %d timed out' % i)
+
+        for what, total, delta in clients[-1].timing_breakdown():
+            if what not in steps:
+                order.append(what)
+            steps.setdefault(what, []).append(delta)
+        if sink.first_frame is not None:
+            first_frame.append((sink.first_frame - sink.start_time) * 1000)
+
+        sink.teardown()
+        iterate_until(lambda: False, 0.5)
+        sink.close()
+
+    print_table('Negotiation steps (time since previous step):',
+                [(what, steps[what]) for what in order])
+    print_table('Sink:', [('connect to first decoded frame', first_frame)])
+
+
+def bench_slices(args):
+    """Encoder throughput and per-frame latency with the frame split into
+    slices, compared to whole frames (1 slice)."""
+    import encoders
+
+    mode = (1920, 1080, 60)
+    for name in encoders.ELEMENTS:
+        if not encoders.available(name):
+            continue
+
+        print('%s at %dx%d@%d, %s profile:' % (name, *mode, args.profile))
+        for slices in (1, 2, 4, 8):
+            def configure(encoder):
+                encoders.set_slices(encoder, name, slices)
+                encoders.set_threads(encoder, name, 0, 'sliced', slices)
+
+            result = encoders.EncoderCapabilities.probe(name, mode, args.profile, configure)
+            if result is None:
+                print('  %2d slices: failed' % slices)
+                continue
+            print('  %2d slices: %6.1f fps  %6.1f ms latency' % (slices, result['fps'], result['latency']))
+
+
+def bench_threads(args):
+    """Encoder throughput and per-frame latency by number of cores, for
+    sliced and frame threads."""
+    import encoders
+
+    mode = (1920, 1080, 60)
+    cpus = sorted(os.sched_getaffinity(0))
+    counts = [n for n in (1, 2, 4, 8, 16) if n < len(cpus)] + [len(cpus)]
+    for name in encoders.ELEMENTS:
+        if not encoders.available(name):
+            continue
+
+        print('%s at %dx%d@%d, %s profile:' % (name, *mode, args.profile))
+        for threading in ('sliced', 'frame'):
+            for n in counts:
+                def configure(encoder):
+                    # One slice per thread for sliced threads
+                    slices = n if threading == 'sliced' else 1
+                    encoders.set_slices(encoder, name, slices)
+                    encoders.set_threads(encoder, name, n, threading, slices)
+
+                # The streaming and encoder threads inherit the affinity
+                os.sched_setaffinity(0, cpus[:n])
+                try:
+                    result = encoders.EncoderCapabilities.probe(name, mode, args.profile, configure)
+                finally:
+                    os.sched_setaffinity(0, cpus)
+                if result is None:
+                    print('  %-6s %2d cores: failed' % (threading, n))
+                    continue
+                print('  %-6s %2d cores: %6.1f fps  %6.1f ms latency' % (threading, n, result['fps'], result['latency']))
+
+
+BENCHMARKS = {
+    'negotiation': bench_negotiation,
+    'slices': bench_slices,
+    'threads': bench_threads,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=10, help='seconds per iteration')
+    parser.add_argument('--port', type=int, default=17236, help='RTSP port of the source')
+    parser.add_argument('--rtp-port', type=int, default=16384)
+    parser.add_argument('--profile', default='interactive', help='encoding profile, see encoders.PROFILES')
+    args = parser.parse_args()
+
+    Gst.init(sys.argv)
+
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,80 @@
+class BitrateController:
+    """Adapts the encoder bitrate to the RTCP receiver reports of the sink.
+
+    The bitrate is reduced multiplicatively as soon as loss or round trip time
+    are too high, and only increased again (additively) after several good
+    reports in a row. The band between LOSS_LOW and LOSS_HIGH keeps the
+    current bitrate, so the rate does not oscillate on a noisy link."""
+
+    # Loss fraction above which the bitrate is reduced
+    LOSS_HIGH = 0.02
+    # Loss fraction below which the bitrate may be increased again
+    LOSS_LOW = 0.005
+    # Round trip time (s) above which we assume queues are building up
+    RTT_HIGH = 0.1
+
+    DECREASE = 0.75
+    INCREASE = 0.05
+    # Number of good reports required before increasing the bitrate
+    HOLD_REPORTS = 3
+    # Never go below this fraction of the negotiated maximum
+    MIN_FRACTION = 0.1
+
+    # RTP clock rate of MPEG-TS, used for the jitter
+    CLOCK_RATE = 90000
+
+    def __init__(self, max_bitrate, set_bitrate):
+        self.max_bitrate = max_bitrate
+        self.min_bitrate = int(max_bitrate * self.MIN_FRACTION)
+        self.bitrate = max_bitrate
+        self._set_bitrate = set_bitrate
+        self._good_reports = 0
+
+        self.loss = 0.0
+        self.jitter = 0.0
+        self.rtt = 0.0
+        self.reports = 0
+
+    def set_limits(self, max_bitrate):
+        """Change the maximum bitrate (e.g. for a new mode), keeping the
+        bitrate adapted so far unless it is out of the new limits."""
+        self.max_bitrate = max_bitrate
+        self.min_bitrate = int(max_bitrate * self.MIN_FRACTION)
+        self.bitrate = max(self.min_bitrate, min(self.max_bitrate, self.bitrate))
+
+    def process_stats(self, stats):
+        """Handle the stats of our RTP source, as found in the "stats" property
+        of the internal RTPSource."""
+        if not stats.get_value('have-rb'):
+            return
+
+        self.update(stats.get_value('rb-fractionlost') / 256,
+                    stats.get_value('rb-jitter') / self.CLOCK_RATE,
+                    stats.get_value('rb-round-trip') / 65536)
+
+    def update(self, loss, jitter, rtt):
+        self.loss = loss
+        self.jitter = jitter
+        self.rtt = rtt
+        self.reports += 1
+
+        if loss > self.LOSS_HIGH or rtt > self.RTT_HIGH:
+            bitrate = int(self.bitrate * self.DECREASE)
+            self._good_reports = 0
+        elif loss < self.LOSS_LOW:
+            self._good_reports += 1
+            if self._good_reports < self.HOLD_REPORTS:
+                return
+            bitrate = self.bitrate + int(self.max_bitrate * self.INCREASE)
+            self._good_reports = 0
+        else:
+            self._good_reports = 0
+            return
+
+        bitrate = max(self.min_bitrate, min(self.max_bitrate, bitrate))
+        if bitrate == self.bitrate:
+            return
+
+        print('INFO: Changing bitrate from %d to %d kbit/s (loss: %.1f%%, jitter: %.1f ms, rtt: %.1f ms)' % (self.bitrate, bitrate, loss * 100, jitter * 1000, rtt * 1000))
+        self.bitrate = bitrate
+        self._set_bitrate(bitrate)
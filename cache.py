@@ -0,0 +1,32 @@
+import json
+import os
+
+from gi.repository import GLib
+
+
+def cache_path(name):
+    return os.path.join(GLib.get_user_cache_dir(), 'miracast', name)
+
+
+def load(name):
+    """Load a JSON cache file, returns None if it does not exist or cannot be
+    parsed."""
+    try:
+        with open(cache_path(name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print('WARNING: Ignoring unreadable cache file %s: %s' % (cache_path(name), e))
+        return None
+
+
+def store(name, data):
+    path = cache_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write atomically, several processes may be running at the same time
+    tmp = path + '.tmp%d' % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
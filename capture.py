@@ -0,0 +1,313 @@
+import gi
+
+gi.require_version('Gst', '1.0')
+
+import os
+import time
+import zlib
+
+import dbus
+
+from gi.repository import Gst
+
+
+class ScreenCastPortal:
+    """Negotiates a screen cast session with xdg-desktop-portal and hands out
+    the PipeWire remote (fd and node id) that pipewiresrc should read from.
+
+    The portal is asynchronous and asks the user for permission, so this has
+    to be started early (before any sink connects). Requires a running GLib
+    mainloop with the dbus GLib integration."""
+
+    BUS_NAME = 'org.freedesktop.portal.Desktop'
+    OBJECT_PATH = '/org/freedesktop/portal/desktop'
+    SCREENCAST_IFACE = 'org.freedesktop.portal.ScreenCast'
+    REQUEST_IFACE = 'org.freedesktop.portal.Request'
+
+    # Source types and cursor modes as defined by the portal API
+    SOURCE_MONITOR = 1
+    CURSOR_EMBEDDED = 2
+
+    def __init__(self):
+        self.bus = dbus.SessionBus()
+        self.portal = self.bus.get_object(self.BUS_NAME, self.OBJECT_PATH)
+        self.session = None
+        self.node_id = None
+        self.fd = None
+        self._token = 0
+        self._ready_cb = None
+
+    def _new_token(self):
+        self._token += 1
+        return 'miracast%d' % self._token
+
+    def _request(self, method, callback, *args, options):
+        token = self._new_token()
+        sender = self.bus.get_unique_name()[1:].replace('.', '_')
+        path = '/org/freedesktop/portal/desktop/request/%s/%s' % (sender, token)
+
+        def response(code, results):
+            match.remove()
+            if code != 0:
+                print('ERROR: Screen cast portal request %s failed (%d)' % (method, code))
+                return
+            callback(results)
+
+        # Subscribe before calling, otherwise we may miss the response
+        match = self.bus.add_signal_receiver(response, 'Response',
+                                             self.REQUEST_IFACE,
+                                             self.BUS_NAME, path)
+        options['handle_token'] = token
+        getattr(self.portal, method)(*args, options,
+                                     dbus_interface=self.SCREENCAST_IFACE)
+
+    def start(self, ready_cb=None):
+        self._ready_cb = ready_cb
+        self._request('CreateSession', self._session_created, options={
+            'session_handle_token': self._new_token(),
+        })
+
+    def _session_created(self, results):
+        self.session = results['session_handle']
+        self._request('SelectSources', self._sources_selected, self.session, options={
+            'types': dbus.UInt32(self.SOURCE_MONITOR),
+            'multiple': False,
+            'cursor_mode': dbus.UInt32(self.CURSOR_EMBEDDED),
+        })
+
+    def _sources_selected(self, results):
+        self._request('Start', self._started, self.session, '', options={})
+
+    def _started(self, results):
+        streams = results.get('streams', [])
+        if not streams:
+            print('ERROR: Screen cast portal did not return any streams')
+            return
+
+        self.node_id = int(streams[0][0])
+        fd = self.portal.OpenPipeWireRemote(self.session, {},
+                                            dbus_interface=self.SCREENCAST_IFACE)
+        self.fd = fd.take()
+
+        print('INFO: Screen cast ready on PipeWire node %d' % self.node_id)
+        if self._ready_cb:
+            self._ready_cb(self)
+
+    @property
+    def ready(self):
+        return self.fd is not None
+
+
+class CaptureSource:
+    """A capture backend producing raw video for the encoder.
+
+    Frames are handed downstream in system memory: the converter only accepts
+    memory:SystemMemory, so DMA-BUF is never negotiated. Backends avoid
+    additional copies where their element allows it.
+
+    frame_changed() tells downstream stages whether a frame carries new
+    content at all. Damage regions are not exposed downstream; it returns
+    None if the backend cannot tell unchanged frames apart."""
+
+    NAME = None
+    ELEMENT = None
+
+    def __init__(self):
+        self.element = None
+        self.frames = 0
+        self.unchanged_frames = 0
+
+    @classmethod
+    def available(cls):
+        return Gst.ElementFactory.find(cls.ELEMENT) is not None
+
+    def _make_element(self):
+        raise NotImplementedError
+
+    def build(self, wfdbin):
+        self.element = self._make_element()
+        wfdbin.add(self.element)
+
+        self.element.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER,
+                                                     self._count_frame)
+
+        return self.element
+
+    def _count_frame(self, pad, info):
+        self.frames += 1
+        if self.frame_changed(info.get_buffer()) is False:
+            self.unchanged_frames += 1
+
+        return Gst.PadProbeReturn.OK
+
+    def frame_changed(self, buf):
+        return None
+
+    def stats(self):
+        return {
+            'source': self.NAME,
+            'frames': self.frames,
+            'unchanged-frames': self.unchanged_frames,
+        }
+
+
+class TestCaptureSource(CaptureSource):
+    NAME = 'test'
+    ELEMENT = 'videotestsrc'
+
+    def _make_element(self):
+        source = Gst.ElementFactory.make(self.ELEMENT)
+        source.props.is_live = True
+        source.props.do_timestamp = True
+        return source
+
+
+class XImageCaptureSource(CaptureSource):
+    NAME = 'ximage'
+    ELEMENT = 'ximagesrc'
+
+    # X display to capture, None uses $DISPLAY
+    DISPLAY = None
+
+    @classmethod
+    def available(cls):
+        if not super().available():
+            return False
+        return cls.DISPLAY is not None or 'DISPLAY' in os.environ
+
+    def _make_element(self):
+        source = Gst.ElementFactory.make(self.ELEMENT)
+        if self.DISPLAY is not None:
+            source.props.display_name = self.DISPLAY
+        # Reads the screen into an XShm segment. With XDamage only the changed
+        # regions are fetched from the X server, but every frame is still
+        # pushed as a complete image without region information.
+        source.props.use_damage = True
+        source.props.show_pointer = True
+        source.props.do_timestamp = True
+        return source
+
+
+class PipeWireCaptureSource(CaptureSource):
+    NAME = 'pipewire'
+    ELEMENT = 'pipewiresrc'
+
+    # Set to a started ScreenCastPortal to capture through the portal
+    PORTAL = None
+
+    @classmethod
+    def available(cls):
+        if not super().available():
+            return False
+        return cls.PORTAL is not None and cls.PORTAL.ready
+
+    def _make_element(self):
+        source = Gst.ElementFactory.make(self.ELEMENT)
+        # pipewiresrc takes ownership of the fd, so hand out a duplicate
+        source.props.fd = os.dup(self.PORTAL.fd)
+        source.props.path = str(self.PORTAL.node_id)
+        # Wrap the memfd memory of the compositor instead of copying it. Only
+        # mappable memory is negotiated, see CaptureSource.
+        source.props.always_copy = False
+        source.props.do_timestamp = True
+        return source
+
+    def frame_changed(self, buf):
+        # The compositor sends buffers without a payload (or flagged as gap)
+        # if e.g. only the cursor moved.
+        if buf.has_flags(Gst.BufferFlags.GAP) or buf.get_size() == 0:
+            return False
+        return True
+
+
+class FrameSkipper:
+    """Drops captured frames that show the same content as the previous one,
+    so they are neither converted, encoded nor sent.
+
+    Uses frame_changed() of the capture backend, falling back to a sampled
+    CRC of the frame. A frame is sent at least every interval seconds
+    (the max skip interval of the sink) to refresh the picture."""
+
+    # The CRC covers every HASH_STEP-th byte, so every row is sampled and a
+    # change of HASH_STEP consecutive bytes (15 pixels in 32 bit formats) is
+    # always seen. The step is prime, so unless the stride is a multiple of
+    # it the sampled columns shift from row to row. Far cheaper than a CRC of
+    # the whole frame.
+    HASH_STEP = 61
+    # Refresh interval for sinks that allow skipping without a time limit
+    MAX_INTERVAL = 2.0
+
+    def __init__(self, capture):
+        self.capture = capture
+        # 0 disables skipping
+        self.interval = 0
+        self.skipped = 0
+        self._last_sent = 0
+        self._last_hash = None
+        self._hashing = True
+
+        capture.element.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self._probe)
+
+    def set_interval(self, interval):
+        """Set the maximum skip interval as returned by
+        VideoCodec.max_skip_interval()."""
+        self.interval = self.MAX_INTERVAL if interval < 0 else min(interval, self.MAX_INTERVAL)
+        self._last_hash = None
+
+    def refresh(self):
+        """Let the next frame through, e.g. for a requested keyframe"""
+        self._last_sent = 0
+
+    def _hash(self, buf):
+        ok, info = buf.map(Gst.MapFlags.READ)
+        if not ok:
+            # e.g. DMA-BUF memory that cannot be mapped
+            self._hashing = False
+            return None
+
+        try:
+            return zlib.crc32(memoryview(info.data)[::self.HASH_STEP].tobytes())
+        finally:
+            buf.unmap(info)
+
+    def _probe(self, pad, info):
+        if self.interval <= 0:
+            return Gst.PadProbeReturn.OK
+
+        buf = info.get_buffer()
+        changed = self.capture.frame_changed(buf)
+        if changed is None and self._hashing:
+            crc = self._hash(buf)
+            changed = crc is None or crc != self._last_hash
+            self._last_hash = crc
+
+        now = time.monotonic()
+        if changed is not False or now - self._last_sent >= self.interval:
+            self._last_sent = now
+            return Gst.PadProbeReturn.OK
+
+        self.skipped += 1
+        return Gst.PadProbeReturn.DROP
+
+
+SOURCES = {
+    PipeWireCaptureSource.NAME: PipeWireCaptureSource,
+    XImageCaptureSource.NAME: XImageCaptureSource,
+    TestCaptureSource.NAME: TestCaptureSource,
+}
+
+
+def make_capture_source(preference):
+    """Returns a CaptureSource for the first available backend in the given
+    preference list."""
+    for name in preference:
+        try:
+            cls = SOURCES[name]
+        except KeyError:
+            print('WARNING: Unknown capture source %s' % name)
+            continue
+
+        if cls.available():
+            return cls()
+
+    raise AssertionError("No capture source found, cannot stream video!")
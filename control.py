@@ -0,0 +1,201 @@
+"""asyncio control API for the WFD source.
+
+The RTSP server and GStreamer run in a GLib main loop in a separate thread,
+sessions are exposed as objects whose negotiation steps can be awaited:
+
+    controller = Controller(WFDServer())
+    await controller.start()
+    session = await controller.accept()
+    await session.playing()
+    ...
+    await session.teardown()
+
+Any number of sessions can be handled concurrently on one asyncio loop."""
+
+import asyncio
+import threading
+import time
+
+from gi.repository import GLib
+
+
+class StepTimeout(asyncio.TimeoutError):
+    def __init__(self, step):
+        super().__init__('Sink did not complete %s in time' % step)
+        self.step = step
+
+
+class SessionClosed(ConnectionError):
+    pass
+
+
+class Session:
+    """A connected sink, wrapping a WFDClient. Steps are the ones emitted in
+    the "wfd-step" signal of the client."""
+
+    STEPS = ['M1', 'M3', 'M4', 'M5', 'SETUP', 'PLAY']
+    # Deadline (s) of each step, counted from the completion of the previous
+    # one (or the connection)
+    DEADLINES = {
+        'M1': 5,
+        'M3': 5,
+        'M4': 5,
+        'M5': 5,
+        'SETUP': 5,
+        'PLAY': 5,
+        'TEARDOWN': 5,
+    }
+    # Number of times the M5 SETUP trigger is repeated if the sink answers
+    # it but does not send SETUP
+    SETUP_RETRIES = 2
+
+    def __init__(self, controller, client):
+        # Created in the GLib thread, futures are only completed in the loop
+        self.controller = controller
+        self.client = client
+        self._loop = controller.loop
+        self._steps = {step: self._loop.create_future() for step in self.STEPS + ['TEARDOWN']}
+        self._closed = self._loop.create_future()
+        # Monotonic time of every completed step
+        self.times = {'connected': time.monotonic()}
+
+        client.connect('wfd-step', self._on_step)
+        client.connect('closed', self._on_closed)
+
+    def _on_step(self, client, step):
+        self._loop.call_soon_threadsafe(self._complete, step, time.monotonic())
+
+    def _complete(self, step, when):
+        self.times[step] = when
+        future = self._steps.get(step)
+        if future is not None and not future.done():
+            future.set_result(when)
+
+    def _on_closed(self, client):
+        self._loop.call_soon_threadsafe(self._set_closed)
+
+    def _set_closed(self):
+        for step, future in self._steps.items():
+            if not future.done():
+                future.set_exception(SessionClosed('Session closed before %s' % step))
+                # Nobody may be waiting for the step
+                future.exception()
+        if not self._closed.done():
+            self._closed.set_result(time.monotonic())
+
+    @property
+    def is_closed(self):
+        return self._closed.done()
+
+    async def step(self, step, timeout=None):
+        """Wait until step is completed, at most timeout seconds (the step's
+        deadline by default). Returns the time it completed."""
+        if timeout is None:
+            timeout = self.DEADLINES[step]
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._steps[step]), timeout)
+        except asyncio.TimeoutError:
+            raise StepTimeout(step) from None
+
+    async def negotiate(self, until='PLAY'):
+        """Wait for all steps up to (and including) until, each with its own
+        deadline. The SETUP trigger is retried if the sink does not react."""
+        for step in self.STEPS[:self.STEPS.index(until) + 1]:
+            retries = self.SETUP_RETRIES if step == 'SETUP' else 0
+            while True:
+                try:
+                    await self.step(step)
+                    break
+                except StepTimeout:
+                    if retries == 0:
+                        raise
+                    retries -= 1
+                    print('WARNING: Sink did not send SETUP, repeating the trigger')
+                    await self.controller.call(self.client.wfd_trigger_method, 'SETUP')
+
+    async def playing(self):
+        await self.negotiate('PLAY')
+
+    async def closed(self):
+        """Wait until the sink disconnected (or was torn down)"""
+        await asyncio.shield(self._closed)
+
+    async def teardown(self):
+        """Ask the sink to tear down the session (M5 TEARDOWN trigger) and
+        wait until it is closed. Sinks that do not react are disconnected."""
+        if self.is_closed:
+            return
+
+        await self.controller.call(self.client.wfd_trigger_method, 'TEARDOWN')
+        try:
+            await asyncio.wait_for(self.closed(), self.DEADLINES['TEARDOWN'])
+        except asyncio.TimeoutError:
+            await self.controller.call(self.client.close)
+            await self.closed()
+
+    async def change_mode(self, width, height, framerate=None, interlaced=None, profile=None):
+        """Returns False if the mode cannot be requested, see
+        WFDClient.wfd_change_mode."""
+        return await self.controller.call(self.client.wfd_change_mode, width, height, framerate, interlaced, profile)
+
+
+class Controller:
+    """Runs a WFDServer in a GLib main loop thread and hands out a Session
+    for every connecting sink."""
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = None
+        self._mainloop = None
+        self._thread = None
+        self._sessions = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._sessions = asyncio.Queue()
+        self._mainloop = GLib.MainLoop()
+        self._thread = threading.Thread(target=self._mainloop.run, name='glib', daemon=True)
+        self._thread.start()
+        await self.call(self._attach)
+
+    def _attach(self):
+        self.server.connect('client-connected', self._client_connected)
+        self.server.attach()
+
+    def _client_connected(self, server, client):
+        # Connect to the client signals right away, before any step happens
+        session = Session(self, client)
+        self.loop.call_soon_threadsafe(self._sessions.put_nowait, session)
+
+    async def accept(self):
+        """Wait for the next sink to connect"""
+        return await self._sessions.get()
+
+    def call(self, func, *args):
+        """Run func in the GLib thread, returns a future for its result"""
+        future = self.loop.create_future()
+
+        def complete(result, exception):
+            # The caller may have given up waiting
+            if future.cancelled():
+                return
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+        def run():
+            try:
+                result = func(*args)
+            except Exception as e:
+                self.loop.call_soon_threadsafe(complete, None, e)
+            else:
+                self.loop.call_soon_threadsafe(complete, result, None)
+            return False
+
+        GLib.idle_add(run)
+        return future
+
+    async def stop(self):
+        self._mainloop.quit()
+        await self.loop.run_in_executor(None, self._thread.join)
@@ -0,0 +1,70 @@
+import struct
+
+
+class DetailedTiming:
+    def __init__(self, data):
+        assert len(data) == 18
+
+        # Pixel clock in 10 kHz units
+        self.pixel_clock = struct.unpack('<H', data[0:2])[0] * 10000
+
+        self.width = data[2] | ((data[4] & 0xf0) << 4)
+        hblank = data[3] | ((data[4] & 0x0f) << 8)
+        height = data[5] | ((data[7] & 0xf0) << 4)
+        vblank = data[6] | ((data[7] & 0x0f) << 8)
+
+        self.interlaced = bool(data[17] & 0x80)
+
+        # The refresh rate is the field rate for interlaced modes, the
+        # vertical values are per field in that case.
+        total = (self.width + hblank) * (height + vblank)
+        if total == 0:
+            raise ValueError('Detailed timing without a size')
+        self.refresh = self.pixel_clock / total
+        self.height = height * 2 if self.interlaced else height
+
+    def __repr__(self):
+        return '%dx%d%s@%.2f' % (self.width, self.height, 'i' if self.interlaced else 'p', self.refresh)
+
+
+class EDID:
+    """Parser for the base block of an EDID (1.3 or 1.4). Extension blocks
+    are kept but not parsed."""
+
+    HEADER = b'\x00\xff\xff\xff\xff\xff\xff\x00'
+    BLOCK_SIZE = 128
+
+    def __init__(self, data):
+        if len(data) < self.BLOCK_SIZE or data[:8] != self.HEADER:
+            raise ValueError('Not an EDID')
+
+        self.data = data
+        if sum(data[:self.BLOCK_SIZE]) & 0xff != 0:
+            print('WARNING: EDID checksum is wrong, continuing anyway')
+
+        # Three 5 bit letters, 'A' is 1
+        mfg = struct.unpack('>H', data[8:10])[0]
+        self.manufacturer = ''.join(chr(((mfg >> shift) & 0x1f) + ord('A') - 1) for shift in (10, 5, 0))
+        self.product, self.serial = struct.unpack('<HI', data[10:16])
+        self.version = (data[18], data[19])
+
+        self.timings = []
+        self.name = None
+        for offset in range(54, 126, 18):
+            descr = data[offset:offset + 18]
+            if descr[0:2] != b'\x00\x00':
+                self.timings.append(DetailedTiming(descr))
+            elif descr[3] == 0xfc:
+                # Display product name
+                self.name = descr[5:18].split(b'\n')[0].decode('ascii', 'replace').strip()
+
+        self.extensions = data[126]
+
+    @property
+    def preferred(self):
+        """The preferred (native) timing, which is always the first detailed
+        timing descriptor."""
+        return self.timings[0] if self.timings else None
+
+    def __repr__(self):
+        return '<EDID %s %04X %s preferred %r>' % (self.manufacturer, self.product, self.name, self.preferred)
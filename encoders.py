@@ -0,0 +1,334 @@
+import gi
+
+gi.require_version('Gst', '1.0')
+
+import os
+import socket
+import time
+
+from gi.repository import Gst
+
+import cache
+
+
+# Short name to element factory for all H.264 encoders we know how to drive
+ELEMENTS = {
+    'x264': 'x264enc',
+    'openh264': 'openh264enc',
+    'va': 'vah264enc',
+}
+
+# Native raw video format of each encoder, the capture is converted to it
+FORMATS = {
+    'x264': 'I420',
+    'openh264': 'I420',
+    'va': 'NV12',
+}
+
+# Named encoding profiles, setting the encoder, muxer and RTP latency
+# together. Per encoder properties are set as is, 'gop' is the keyframe
+# interval in seconds, 'mux_latency' is the mpegtsmux latency (ns),
+# 'latency' the rtpbin/media factory latency (ms) and 'threading' the
+# encoder threading mode (see set_threads).
+#
+# The delays below are unmeasured estimates of the source side budget for
+# 1080p60: capture (one frame) + encode + mux + payload/send. The sink
+# decoder and display pipeline come on top. Actual numbers depend on the
+# encoder, threading and host; measure them with "bench.py threads" and the
+# pipeline profiler (MIRACAST_PROFILE) before relying on them.
+PROFILES = {
+    # Estimate ~25 ms: capture 17 ms, encode ~5 ms, no mux/RTP buffering.
+    # Periodic intra refresh instead of IDR frames avoids bitrate spikes.
+    'interactive': {
+        'x264': {'tune': 'zerolatency', 'speed_preset': 'ultrafast', 'intra_refresh': True, 'rc_lookahead': 0},
+        'openh264': {'complexity': 'low'},
+        'va': {'target_usage': 7},
+        'gop': 1,
+        'mux_latency': 0,
+        'latency': 0,
+        'threading': 'sliced',
+    },
+    # Estimate ~60 ms: capture 17 ms, encode ~10 ms, 40 ms RTP latency to
+    # smooth out scheduling jitter (the previously hardcoded factory latency).
+    'balanced': {
+        'x264': {'tune': 'zerolatency', 'speed_preset': 'superfast', 'intra_refresh': False, 'rc_lookahead': 0},
+        'openh264': {'complexity': 'medium'},
+        'va': {'target_usage': 4},
+        'gop': 1,
+        'mux_latency': 0,
+        'latency': 40,
+        'threading': 'sliced',
+    },
+    # Estimate ~250 ms: frame threads and a 10 frame rate control lookahead
+    # in x264, for video content where compression efficiency matters.
+    'quality': {
+        'x264': {'tune': 0, 'speed_preset': 'veryfast', 'intra_refresh': False, 'rc_lookahead': 10},
+        'openh264': {'complexity': 'high'},
+        'va': {'target_usage': 1},
+        'gop': 2,
+        'mux_latency': 20 * Gst.MSECOND,
+        'latency': 100,
+        'threading': 'frame',
+    },
+}
+
+
+def available(name):
+    return Gst.ElementFactory.find(ELEMENTS[name]) is not None
+
+
+def make_encoder(name, profile):
+    """Create an encoder element with the settings that are independent of the
+    negotiated mode. Returns None if the encoder is not installed."""
+    encoder = Gst.ElementFactory.make(ELEMENTS[name])
+    if encoder is None:
+        return None
+
+    if name == 'openh264':
+        # Single threaded unless configured otherwise, see set_threads
+        # (multi-threading needs slices: https://github.com/cisco/openh264/issues/2618)
+        encoder.props.multi_thread = 1
+        encoder.props.usage_type = "screen"
+        encoder.props.slice_mode = "n-slices"
+        encoder.props.num_slices = 1
+        encoder.props.rate_control = 'bitrate'
+        encoder.props.gop_size = 30
+        encoder.props.enable_frame_skip = False
+        #encoder.props.background_detection = False
+        #encoder.props.adaptive_quantization = False
+        #encoder.props.max_slice_size = 5000
+        #encoder.props.complexity = 0
+        #encoder.props.deblocking = "off"
+    elif name == 'x264':
+        encoder.load_preset('Profile High')
+    else:
+        # VA-API, hardware rate control
+        encoder.props.rate_control = 'cbr'
+        encoder.props.b_frames = 0
+
+    for prop, value in PROFILES[profile][name].items():
+        setattr(encoder.props, prop, value)
+
+    return encoder
+
+
+def set_slices(encoder, name, slices):
+    """Encode every frame as the given number of slices. With sliced
+    threads the slices of a frame are encoded in parallel, which lowers the
+    latency of each frame, see set_threads."""
+    if name == 'openh264':
+        encoder.props.num_slices = slices
+    elif name == 'x264':
+        encoder.props.option_string = 'slices=%d' % slices if slices > 1 else ''
+    else:
+        encoder.props.num_slices = slices
+
+
+def set_threads(encoder, name, threads, mode, slices):
+    """Configure the encoder threads, 0 selects the number of cores.
+
+    'sliced' threads encode the slices of one frame in parallel and add no
+    latency, but there can only be as many threads as slices. If the sink
+    does not support slices, the encoder runs single threaded. 'frame'
+    threads encode several frames at once, which scales better but delays
+    every frame by the number of threads. openh264 only threads over slices,
+    hardware encoders are not affected."""
+    threads = threads or os.cpu_count()
+    if name == 'x264':
+        if mode == 'frame':
+            encoder.props.sliced_threads = False
+            encoder.props.threads = threads
+        else:
+            # Frame threads would add a frame of latency per thread
+            encoder.props.sliced_threads = slices > 1
+            encoder.props.threads = min(threads, slices)
+    elif name == 'openh264':
+        encoder.props.multi_thread = min(threads, slices)
+
+
+def pin_streaming_thread(pad, cpus):
+    """Restrict the streaming thread pushing on pad to the given CPUs. Threads
+    it creates afterwards (e.g. the x264 worker threads, which are started
+    with the caps) inherit the affinity."""
+    def probe(pad, info):
+        # The first event (stream-start) is pushed from the streaming thread,
+        # pid 0 is the calling thread.
+        os.sched_setaffinity(0, cpus)
+        return Gst.PadProbeReturn.REMOVE
+
+    pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, probe)
+
+
+class EncoderCapabilities:
+    """Measured real-time performance of the installed encoders.
+
+    Every available encoder is run through a short encode of a test pattern
+    at each of the PROBE_MODES. The results are cached per host, so the probe
+    only runs again if the host, GStreamer or one of the encoders changes.
+
+    Results are specific to the encoding profile."""
+
+    # width, height, framerate
+    PROBE_MODES = [
+        (1280,  720, 30),
+        (1280,  720, 60),
+        (1920, 1080, 30),
+        (1920, 1080, 60),
+    ]
+    PROBE_FRAMES = 120
+    PROBE_TIMEOUT = 30 * Gst.SECOND
+
+    # Required fps margin over the mode framerate to be considered real-time
+    HEADROOM = 1.2
+
+    def __init__(self, profile, results=None):
+        self.profile = profile
+        # results[encoder]["WxH@F"] = {'fps': ..., 'latency': ... (ms)}, or
+        # {'fps': 0, 'failed': True} if the encoder did not work in that mode
+        self.results = results or {}
+        self._masks = {}
+
+    @staticmethod
+    def _mode_key(mode):
+        return '%dx%d@%d' % mode[:3]
+
+    @staticmethod
+    def _cache_name(profile):
+        return 'encoders-%s-%s.json' % (socket.gethostname(), profile)
+
+    @staticmethod
+    def fingerprint():
+        fp = {'gstreamer': Gst.version_string()}
+        for name, element in ELEMENTS.items():
+            factory = Gst.ElementFactory.find(element)
+            if factory is None:
+                continue
+            plugin = factory.get_plugin()
+            fp[name] = plugin.get_version() if plugin else 'unknown'
+        return fp
+
+    @classmethod
+    def load_or_probe(cls, profile):
+        cached = cache.load(cls._cache_name(profile))
+        fingerprint = cls.fingerprint()
+        if cached and cached.get('fingerprint') == fingerprint:
+            return cls(profile, cached['results'])
+
+        print('INFO: Probing encoder performance, this takes a moment')
+        caps = cls(profile)
+        for name in ELEMENTS:
+            if not available(name):
+                continue
+            for mode in cls.PROBE_MODES:
+                result = cls.probe(name, mode, profile)
+                if result is None:
+                    # Recorded, so the mode is not treated as unprobed
+                    result = {'fps': 0, 'failed': True}
+                caps.results.setdefault(name, {})[cls._mode_key(mode)] = result
+
+        cache.store(cls._cache_name(profile), {'fingerprint': fingerprint, 'results': caps.results})
+        return caps
+
+    @classmethod
+    def probe(cls, name, mode, profile, configure=None):
+        """Encode PROBE_FRAMES frames as fast as possible and measure the
+        throughput and the per-frame encoder latency. configure is called
+        with the encoder to change its settings."""
+        pipeline = Gst.Pipeline()
+        source = Gst.ElementFactory.make('videotestsrc')
+        source.props.num_buffers = cls.PROBE_FRAMES
+        source.props.pattern = 'smpte'
+        filt = Gst.ElementFactory.make('capsfilter')
+        filt.props.caps = Gst.Caps.from_string(
+            'video/x-raw,format=%s,width=%d,height=%d,framerate=%d/1' % (FORMATS[name], *mode))
+        encoder = make_encoder(name, profile)
+        if configure is not None:
+            configure(encoder)
+        sink = Gst.ElementFactory.make('fakesink')
+        sink.props.sync = False
+
+        for element in (source, filt, encoder, sink):
+            pipeline.add(element)
+        assert source.link(filt)
+        assert filt.link(encoder)
+        assert encoder.link(sink)
+
+        entered = {}
+        latencies = []
+
+        def encoder_in(pad, info):
+            entered[info.get_buffer().pts] = time.monotonic()
+            return Gst.PadProbeReturn.OK
+
+        def encoder_out(pad, info):
+            start = entered.pop(info.get_buffer().pts, None)
+            if start is not None:
+                latencies.append(time.monotonic() - start)
+            return Gst.PadProbeReturn.OK
+
+        encoder.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, encoder_in)
+        encoder.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, encoder_out)
+
+        start = time.monotonic()
+        pipeline.set_state(Gst.State.PLAYING)
+        msg = pipeline.get_bus().timed_pop_filtered(cls.PROBE_TIMEOUT,
+                                                   Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        elapsed = time.monotonic() - start
+        pipeline.set_state(Gst.State.NULL)
+
+        if msg is None or msg.type != Gst.MessageType.EOS or not latencies:
+            print('WARNING: Probing %s at %s failed' % (name, cls._mode_key(mode)))
+            return None
+
+        result = {
+            'fps': len(latencies) / elapsed,
+            'latency': 1000 * sum(latencies) / len(latencies),
+        }
+        print('INFO: %s at %s: %.1f fps, %.1f ms latency' % (name, cls._mode_key(mode), result['fps'], result['latency']))
+        return result
+
+    def estimate_fps(self, name, resolution):
+        """Estimate the achievable fps of an encoder for a resolution. Modes
+        that were not probed are extrapolated from the closest successfully
+        probed mode by pixel count. Returns None without data, 0 if every
+        probe of the encoder failed."""
+        results = self.results.get(name)
+        if not results:
+            return None
+
+        result = results.get(self._mode_key(resolution))
+        if result is not None:
+            return result['fps']
+
+        pixels = resolution[0] * resolution[1]
+        best = None
+        for mode in self.PROBE_MODES:
+            result = results.get(self._mode_key(mode))
+            if result is None or result.get('failed'):
+                continue
+            dist = abs(mode[0] * mode[1] - pixels)
+            if best is None or dist < best[0]:
+                best = (dist, result['fps'] * mode[0] * mode[1] / pixels)
+
+        return best[1] if best else 0
+
+    def can_sustain(self, name, resolution):
+        fps = self.estimate_fps(name, resolution)
+        return fps is not None and fps >= resolution[2] * self.HEADROOM
+
+    def feasible_mask(self, name, modes):
+        """Returns a bitmask of the modes (indexed like the given list) that
+        the encoder can sustain. All modes are feasible if the encoder was not
+        probed at all, a failed probe makes a mode infeasible."""
+        key = (name, tuple(modes))
+        if key not in self._masks:
+            mask = 0
+            for b, mode in enumerate(modes):
+                if name not in self.results or self.can_sustain(name, mode):
+                    mask |= 1 << b
+            self._masks[key] = mask
+        return self._masks[key]
+
+
+# Set at startup, see EncoderCapabilities.load_or_probe
+CAPABILITIES = EncoderCapabilities('balanced')
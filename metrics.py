@@ -0,0 +1,96 @@
+from gi.repository import Gio
+from gi.repository import GLib
+
+
+def escape_label(value):
+    """Escape a label value as required by the text exposition format"""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Metric:
+    def __init__(self, name, kind, help, value, labels=None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.value = value
+        self.labels = labels or {}
+
+    def sample(self, labels):
+        labels = dict(labels, **self.labels)
+        if labels:
+            label_str = '{%s}' % ','.join('%s="%s"' % (k, escape_label(v))
+                                          for k, v in sorted(labels.items()))
+        else:
+            label_str = ''
+        return '%s%s %s' % (self.name, label_str, float(self.value))
+
+
+def gauge(name, help, value, **labels):
+    return Metric(name, 'gauge', help, value, labels)
+
+
+def counter(name, help, value, **labels):
+    return Metric(name, 'counter', help, value, labels)
+
+
+def format_metrics(sources):
+    """Render the metrics of several sources in the Prometheus text format.
+    sources is a list of (labels, [Metric, ...])."""
+    by_name = {}
+    order = []
+    for labels, metrics in sources:
+        for metric in metrics:
+            if metric.value is None:
+                continue
+            if metric.name not in by_name:
+                order.append(metric.name)
+                by_name[metric.name] = (metric, [])
+            by_name[metric.name][1].append(metric.sample(labels))
+
+    lines = []
+    for name in order:
+        metric, samples = by_name[name]
+        lines.append('# HELP %s %s' % (name, metric.help))
+        lines.append('# TYPE %s %s' % (name, metric.kind))
+        lines.extend(samples)
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """Minimal HTTP server exporting the metrics of all clients of a
+    WFDServer for Prometheus, e.g. at http://localhost:9236/metrics"""
+
+    def __init__(self, wfd_server, port=9236, address='127.0.0.1'):
+        self.wfd_server = wfd_server
+        self.service = Gio.SocketService()
+        self.service.add_address(Gio.InetSocketAddress.new_from_string(address, port),
+                                 Gio.SocketType.STREAM, Gio.SocketProtocol.TCP, None)
+        self.service.connect('incoming', self._incoming)
+
+    def start(self):
+        self.service.start()
+
+    def _incoming(self, service, connection, source_object):
+        # We answer every request with the metrics, so the request does not
+        # need to be parsed. It is read asynchronously, a slow client must
+        # not block the main loop.
+        connection.get_input_stream().read_bytes_async(4096, GLib.PRIORITY_DEFAULT, None,
+                                                       self._request_read, connection)
+        return True
+
+    def _request_read(self, stream, result, connection):
+        try:
+            stream.read_bytes_finish(result)
+        except GLib.Error as e:
+            print('WARNING: Reading metrics request failed: %s' % e.message)
+            connection.close(None)
+            return
+
+        body = format_metrics(self.wfd_server.collect_metrics()).encode('utf-8')
+        header = ('HTTP/1.0 200 OK\r\n'
+                  'Content-Type: text/plain; version=0.0.4\r\n'
+                  'Content-Length: %d\r\n\r\n' % len(body)).encode('ascii')
+        # A few kB, this fits into the socket buffer
+        connection.get_output_stream().write_all(header + body, None)
+        connection.close(None)
@@ -0,0 +1,123 @@
+import gi
+
+gi.require_version('Gst', '1.0')
+
+import os
+import statistics
+import threading
+import time
+
+from gi.repository import Gst
+
+
+def enable_tracers(logfile=None):
+    """Enable the GStreamer latency and rusage tracers. This only works before
+    Gst.init() is called, the tracer output goes to the debug log (logfile if
+    given). Existing settings in the environment are kept."""
+    os.environ.setdefault('GST_TRACERS', 'latency(flags=element+pipeline);rusage')
+    os.environ.setdefault('GST_DEBUG', 'GST_TRACER:7')
+    if logfile is not None:
+        os.environ.setdefault('GST_DEBUG_FILE', logfile)
+
+
+class ElementProfile:
+    # Buffers that never leave the element (e.g. dropped by the encoder) are
+    # forgotten once this many are outstanding.
+    MAX_PENDING = 100
+
+    def __init__(self, name, element):
+        self.name = name
+        self.factory = element.get_factory().get_name() if element.get_factory() else '?'
+        self.buffers = 0
+        # ms per buffer
+        self.latencies = []
+        self.cpu = []
+        self._entered = {}
+
+        if self._has_sink_pads(element):
+            # All sink pads, including request pads (e.g. sink_%d of the
+            # muxer), also those requested later
+            for pad in element.sinkpads:
+                pad.add_probe(Gst.PadProbeType.BUFFER, self._sink_probe)
+            element.connect('pad-added', self._pad_added)
+            element.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self._src_probe)
+        else:
+            element.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self._source_probe)
+
+    @staticmethod
+    def _has_sink_pads(element):
+        if element.sinkpads:
+            return True
+        factory = element.get_factory()
+        return factory is not None and any(template.direction == Gst.PadDirection.SINK
+                                           for template in factory.get_static_pad_templates())
+
+    def _pad_added(self, element, pad):
+        if pad.get_direction() == Gst.PadDirection.SINK:
+            pad.add_probe(Gst.PadProbeType.BUFFER, self._sink_probe)
+
+    def _sink_probe(self, pad, info):
+        if len(self._entered) > self.MAX_PENDING:
+            self._entered.clear()
+        self._entered[info.get_buffer().pts] = (time.monotonic(), threading.get_ident(), time.thread_time())
+        return Gst.PadProbeReturn.OK
+
+    def _src_probe(self, pad, info):
+        self.buffers += 1
+        entered = self._entered.pop(info.get_buffer().pts, None)
+        if entered is None:
+            return Gst.PadProbeReturn.OK
+
+        start, thread, cpu = entered
+        self.latencies.append((time.monotonic() - start) * 1000)
+        # CPU time can only be attributed if the element processed the buffer
+        # in the calling streaming thread. Work done in internal threads (e.g.
+        # x264 frame threads) is not included, use the rusage tracer for it.
+        if thread == threading.get_ident():
+            self.cpu.append((time.thread_time() - cpu) * 1000)
+        return Gst.PadProbeReturn.OK
+
+    def _source_probe(self, pad, info):
+        # The latency of a source is the age of its buffers when pushed
+        self.buffers += 1
+        element = pad.get_parent_element()
+        clock = element.get_clock()
+        buf = info.get_buffer()
+        if clock is not None and buf.pts != Gst.CLOCK_TIME_NONE:
+            self.latencies.append((clock.get_time() - element.get_base_time() - buf.pts) / Gst.MSECOND)
+        return Gst.PadProbeReturn.OK
+
+    @staticmethod
+    def _describe(values):
+        if not values:
+            return '%8s %8s %8s' % ('n/a', 'n/a', 'n/a')
+        values = sorted(values)
+        return '%8.2f %8.2f %8.2f' % (statistics.median(values),
+                                      values[int(len(values) * 0.95)],
+                                      values[-1])
+
+    def summary(self):
+        return '%-10s %-14s %8d  %s  %s' % (self.name, self.factory, self.buffers,
+                                            self._describe(self.latencies),
+                                            self._describe(self.cpu))
+
+
+class PipelineProfiler:
+    """Per-element latency and CPU time of the streaming pipeline, measured
+    with pad probes on the elements' sink and source pads."""
+
+    def __init__(self):
+        self.elements = {}
+        self.started = time.monotonic()
+
+    def add(self, name, element):
+        """Start profiling element, replacing an element of the same name."""
+        self.elements[name] = ElementProfile(name, element)
+
+    def summary(self):
+        lines = ['Pipeline profile over %.1f s, times in ms (median / 95%% / max):' % (time.monotonic() - self.started),
+                 '%-10s %-14s %8s  %-26s  %-26s' % ('stage', 'element', 'buffers', 'latency', 'cpu')]
+        for profile in self.elements.values():
+            lines.append(profile.summary())
+        lines.append('%s, tracers: %s' % (Gst.version_string(), os.environ.get('GST_TRACERS', 'none')))
+        return '\n'.join(lines)
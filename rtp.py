@@ -5,72 +5,344 @@ gi.require_version('GstRtsp', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 gi.require_version('GstVideo', '1.0')
 
+import collections
 import copy
+import fcntl
+import struct
+import termios
+import time
 
+from gi.repository import Gio
 from gi.repository import GLib
 from gi.repository import Gst
 from gi.repository import GstRtsp
 from gi.repository import GstRtspServer
 from gi.repository import GstVideo
 
+import bitrate
+import capture
+import encoders
+import metrics
+import profiling
+
+
 class WFDMedia(GstRtspServer.RTSPMedia):
 
     __gtype_name__ = "WFDMedia"
-    # Preference list of encoder options
-    ENCODERS = ["x264", "openh264"]
-    ENCODER = ENCODERS[0]
+    # Preference list of encoder options, used if there is no benchmark data
+    # that allows selecting the fastest one, see encoders.EncoderCapabilities
+    ENCODERS = ["x264", "openh264", "va"]
+    # Preference list of capture sources, see capture.SOURCES
+    SOURCES = ["pipewire", "ximage", "test"]
+    # Encoding profile, see encoders.PROFILES
+    PROFILE = "interactive"
+    # Number of encoder threads (0 for one per core), the threading mode is
+    # part of the profile, see encoders.set_threads
+    ENCODER_THREADS = 0
+    # CPUs for the streaming thread doing capture, conversion and encoding
+    # (and the encoder's worker threads), None to not restrict it
+    ENCODER_AFFINITY = None
+    # Threads used to scale and convert the captured video, 0 for one per
+    # core
+    CONVERT_THREADS = 0
+    # Skip frames without new content if the sink allows it, see
+    # capture.FrameSkipper
+    FRAME_SKIP = True
+    # Number of slices per frame, if the sink supports slices, see
+    # encoders.set_slices
+    SLICES = 4
+    # Throughput of the wifi link in Mbit/s (None for no limit) and the
+    # fraction of it that is usable for the stream
+    LINK_THROUGHPUT = None
+    LINK_EFFICIENCY = 0.5
+    # Preference list of audio formats, empty to disable audio
+    AUDIO_FORMATS = ["AAC", "LPCM"]
+    AAC_ENCODERS = ["fdkaacenc", "avenc_aac", "voaacenc"]
+    # Pulseaudio (or pipewire-pulse) device to capture audio from
+    AUDIO_DEVICE = "@DEFAULT_MONITOR@"
+    # PID of the primary audio stream as defined by the WFD specification
+    AUDIO_PID = 0x1100
+    # Minimum time between two forced keyframes in seconds, IDR requests that
+    # arrive in between are coalesced into one.
+    KEYFRAME_MIN_INTERVAL = 0.5
+    # ULPFEC (RFC 5109) protection of the RTP stream. Sinks need to support
+    # it, so it is disabled by default. The overhead follows the loss the
+    # sink reports (FEC_LOSS_FACTOR times the loss percentage), up to
+    # FEC_MAX_PERCENTAGE percent of the media packets.
+    FEC_MAX_PERCENTAGE = 0
+    FEC_LOSS_FACTOR = 3
+    FEC_PT = 122
+    # Send RTP packets at no more than PACING_FACTOR times the target bitrate,
+    # so that keyframes are spread out instead of overflowing the wifi driver
+    # queues in one burst. 0 disables pacing.
+    PACING_FACTOR = 2.0
+    # Send buffer size (bytes) of the UDP media sockets
+    UDP_BUFFER_SIZE = 1024 * 1024
+    # DSCP of the media packets, AF41 is mapped to the WMM video access
+    # category (AC_VI)
+    DSCP = 34
+    # Maximum time (s) worth of data (at the target bitrate) queued in the
+    # socket of a TCP interleaved transport. Beyond that video is dropped up
+    # to the next keyframe instead of adding latency.
+    TCP_MAX_DELAY = 0.1
+    # Target bitrate (kbit/s) assumed before a mode is configured
+    DEFAULT_BITRATE = 20000
+    # Write the pipeline graph to GST_DEBUG_DUMP_DOT_DIR
+    DUMP_DOT = False
+    # Measure per-element latency and CPU time, a summary is printed when
+    # the media is unprepared. See profiling.py.
+    PROFILING = False
 
     def __init__(self, **kwargs):
+        self.idr_requests = 0
+        self.idr_sent = 0
+        self._last_keyframe = 0
+        self._keyframe_pending = False
+        self.rtpbin = None
+        self.fec_encoder = None
+        self.bitrate_controller = None
+        self.configured_key = None
+        # H.264 profile the encoder was configured for, see _apply_mode
+        self.codec_profile = None
+        self.audio_encoder = None
+        # Age of the newest buffer at the muxer input, per stream
+        self._mux_input_delay = {}
+        # Counted by the encoder pad probes, see _attach_encoder_probes. PTS of
+        # the frames inside the encoder, oldest first.
+        self._encoder_pending = collections.deque()
+        self.encoded_frames = 0
+        self.encoded_bytes = 0
+        self.encoded_fps = 0.0
+        self.encoded_bitrate = 0.0
+        self._rate_window = (time.monotonic(), 0, 0)
+        # Stats of our RTP source as last seen by the rtpbin
+        self.rtp_stats = None
+        # Time the last RTCP packet of a sink arrived
+        self.last_rtcp = None
+        self.profiler = profiling.PipelineProfiler() if self.PROFILING else None
+        # Set for TCP interleaved transports, see set_tcp_socket
+        self._tcp_fd = None
+        self._tcp_dropping = False
+        self._tcp_keyframe_requested = False
+        # PTS of the frame passing the TCP probe and whether it is dropped
+        self._tcp_frame_pts = None
+        self._tcp_drop_frame = False
+        self.tcp_queued = 0
+        self.tcp_dropped_frames = 0
+        self.tcp_dropped_bytes = 0
+        # The multiudpsink sending our RTP packets
+        self.rtp_sink = None
+
         pipeline = Gst.Pipeline(name="wfdstream")
 
         wfdbin = Gst.Bin()
         self._build_pipeline(wfdbin)
-        Gst.debug_bin_to_dot_file(wfdbin,
-                                  Gst.DebugGraphDetails.MEDIA_TYPE,
-                                  "wfdmedia-stream")
+        if self.DUMP_DOT:
+            Gst.debug_bin_to_dot_file(wfdbin,
+                                      Gst.DebugGraphDetails.MEDIA_TYPE,
+                                      "wfdmedia-stream")
         pipeline.add(wfdbin)
 
         super().__init__(element=pipeline, **kwargs)
 
+        if self.profiler is not None:
+            for name in ('source', 'convert', 'interlace', 'encoder', 'parse', 'mpegmux', 'payloader'):
+                self.profiler.add(name, getattr(self, name))
+            self.connect('unprepared', lambda media: print(self.profiler.summary()))
+
+        self.connect('new-state', self._new_state)
+
     def do_setup_rtpbin(self, rtpbin):
+        rtpbin.props.latency = encoders.PROFILES[self.PROFILE]['latency']
         rtpbin.props.rtp_profile = "avp"
-        rtpbin.props.do_retransmission = True
+        # Retransmission (RFC 4588) is set up by the stream, see
+        # WFDMediaFactory.RETRANSMISSION_TIME
         rtpbin.props.ntp_time_source = 3
         rtpbin.props.buffer_mode = "none"
         rtpbin.props.max_misorder_time = 50
         rtpbin.props.do_lost = True
         rtpbin.props.do_sync_event = True
 
+        # Emitted for every RTCP packet received from the sink
+        self.rtpbin = rtpbin
+        rtpbin.connect('on-ssrc-active', self._on_ssrc_active)
+        # Connected before the stream joins the rtpbin, so this handler
+        # provides the encoder.
+        rtpbin.connect('request-fec-encoder', self._request_fec_encoder)
+
         return True
 
+    def _request_fec_encoder(self, rtpbin, session_id):
+        if self.FEC_MAX_PERCENTAGE <= 0:
+            return None
+
+        self.fec_encoder = Gst.ElementFactory.make('rtpulpfecenc')
+        if self.fec_encoder is None:
+            print('WARNING: rtpulpfecenc is missing, sending without FEC')
+            return None
+        self.fec_encoder.props.pt = self.FEC_PT
+        # Starts without overhead until the sink reports loss
+        self.fec_encoder.props.percentage = 0
+        return self.fec_encoder
+
+    def _update_fec(self, loss):
+        percentage = min(self.FEC_MAX_PERCENTAGE, int(round(loss * 100 * self.FEC_LOSS_FACTOR)))
+        if percentage != self.fec_encoder.props.percentage:
+            print('INFO: Changing FEC overhead from %d%% to %d%% (loss: %.1f%%)' % (self.fec_encoder.props.percentage, percentage, loss * 100))
+            self.fec_encoder.props.percentage = percentage
+
+    def _on_ssrc_active(self, rtpbin, session_id, ssrc):
+        self.last_rtcp = time.monotonic()
+
+        # Receiver reports are accounted on our own (internal) source. With a
+        # shared media all sinks report on it, and as increasing the bitrate
+        # needs several good reports in a row, the worst sink dominates.
+        session = rtpbin.emit('get-internal-session', session_id)
+        for source in session.props.sources:
+            if source.props.ssrc == self.payloader.props.ssrc:
+                self.rtp_stats = source.props.stats
+                if self.bitrate_controller is not None:
+                    self.bitrate_controller.process_stats(self.rtp_stats)
+                if self.fec_encoder is not None and self.rtp_stats.get_value('have-rb'):
+                    self._update_fec(self.rtp_stats.get_value('rb-fractionlost') / 256)
+                break
+
+    def _new_state(self, media, state):
+        # The RTSP stream creates the UDP sinks when the transports are set up
+        if state == Gst.State.PLAYING and self.rtp_sink is None:
+            self._setup_udp_sinks()
+
+    def _setup_udp_sinks(self):
+        rtp_socket = self.get_stream(0).get_rtp_socket(Gio.SocketFamily.IPV4)
+        for element in self.get_element().get_parent().iterate_recurse():
+            factory = element.get_factory()
+            if factory is None or factory.get_name() != 'multiudpsink':
+                continue
+
+            element.props.qos_dscp = self.DSCP
+            element.props.buffer_size = self.UDP_BUFFER_SIZE
+            if rtp_socket is not None and element.props.socket == rtp_socket:
+                self.rtp_sink = element
+
+        if self.rtp_sink is not None and self.bitrate_controller is not None:
+            self._set_pacing(self.bitrate_controller.bitrate)
+
+    def _set_pacing(self, bitrate):
+        # max-bitrate of the sink throttles rendering to spread out the packets
+        self.rtp_sink.props.max_bitrate = int(bitrate * 1000 * self.PACING_FACTOR)
+
+    def connect_first_packet(self, callback):
+        """Call callback (from the streaming thread) once the first RTP packet
+        has been produced."""
+        def probe(pad, info):
+            callback()
+            return Gst.PadProbeReturn.REMOVE
+
+        self.payloader.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, probe)
+
+    def set_bitrate(self, bitrate):
+        """Set the encoder target bitrate in kbit/s"""
+        if self.encoder_name == 'openh264':
+            self.encoder.props.bitrate = bitrate * 1024
+        else:
+            self.encoder.props.bitrate = bitrate
+
+        if self.rtp_sink is not None:
+            self._set_pacing(bitrate)
+
+    @staticmethod
+    def _native_mode(params, codec):
+        """The mode matching the preferred timing of the display (from the
+        EDID), so that the sink does not need to scale. Falls back to the
+        native mode reported in wfd_video_formats."""
+        timing = params.native_timing()
+        if timing is not None:
+            resolution = codec.find_resolution(timing.width, timing.height,
+                                               round(timing.refresh), timing.interlaced)
+            if resolution is not None:
+                return resolution
+
+        return codec.get_native_resolution()
+
     @classmethod
-    def _find_codec(cls, params, profile=None):
-        # Try to find a base profile
-        for codec in params.video_codecs:
-            if profile is None or codec.profile == profile:
-                return codec
+    def _select_mode(cls, params):
+        """Find the best feasible (encoder, codec, resolution) combination.
+
+        The modes of every codec of the sink are intersected with the modes
+        the link can carry and the modes each encoder can sustain. The
+        display's native mode wins if it is feasible, otherwise the best feasible mode.
+        Ties are broken by the encoder speed and the codec profile."""
+        best = None
+        for encoder in cls.ENCODERS:
+            if not encoders.available(encoder):
+                continue
+
+            for codec in params.video_codecs:
+                link_mask = -1
+                if cls.LINK_THROUGHPUT is not None:
+                    link_mask = codec.link_mask(cls.LINK_THROUGHPUT * 1000 * cls.LINK_EFFICIENCY)
+                mask = codec.modes_mask & link_mask & encoders.CAPABILITIES.feasible_mask(encoder, codec.MODES)
+                if not mask:
+                    continue
 
-        return None
+                native = cls._native_mode(params, codec)
+                if native is not None and mask >> codec.mode_bit(native) & 1:
+                    resolution = native
+                else:
+                    resolution = codec.best_mode(mask)
+
+                # openh264 only supports the base profile
+                profile_match = (codec.profile == 'CBP') == (encoder == 'openh264')
+                score = (resolution == native,
+                         -codec.MODE_ORDER.index(codec.mode_bit(resolution)),
+                         encoders.CAPABILITIES.estimate_fps(encoder, resolution) or 0,
+                         profile_match)
+                if best is None or score > best[0]:
+                    best = (score, encoder, codec, resolution)
+
+        if best is None:
+            return cls._fallback_mode(params)
+        return best[1:]
+
+    @classmethod
+    def _fallback_mode(cls, params):
+        """The least demanding mode of the sink with the preferred installed
+        encoder. Used if no mode is known to be feasible (e.g. all encoder
+        probes failed or the link is slow on paper), streaming something is
+        better than failing the negotiation."""
+        encoder = next((e for e in cls.ENCODERS if encoders.available(e)), None)
+        if encoder is None:
+            return None, None, None
+
+        best = None
+        for codec in params.video_codecs:
+            resolution = codec.worst_mode(codec.modes_mask)
+            if resolution is None:
+                continue
+            order = codec.MODE_ORDER.index(codec.mode_bit(resolution))
+            if best is None or order > best[0]:
+                best = (order, codec, resolution)
+
+        if best is None:
+            return None, None, None
+        print('WARNING: No mode is known to be feasible, falling back to %dx%d@%d' % best[2][:3])
+        return encoder, best[1], best[2]
 
     @classmethod
     def wfd_select_codecs(cls, params):
         if hasattr(params, 'selected_resolution'):
             return
 
-        if cls.ENCODER == 'openh264':
-            codec = cls._find_codec(params, profile='CBP')
-        else:
-            codec = cls._find_codec(params, profile='CHP')
-        if not codec:
-            codec = cls._find_codec(params)
+        encoder, codec, resolution = cls._select_mode(params)
+        if encoder is None:
+            raise AssertionError("No encoder installed or no video mode reported, cannot stream video!")
 
         print('Using codec with resolutions:', codec.get_resolutions())
         print('Reported native resolution:', codec.get_native_resolution())
-        resolution = codec.find_best_resolution()
-        resolution = codec.find_resolution(1920, 1080)
         print('Resolution:', resolution)
+        print('Encoder:', encoder)
 
-        if cls.ENCODER == 'openh264':
+        if encoder == 'openh264':
             codec = copy.copy(codec)
             codec.profile = 'CBP'
             # This seems to improve the MONTOVIEW a lot, but no idea why
@@ -78,31 +350,132 @@ class WFDMedia(GstRtspServer.RTSPMedia):
 
         params.selected_codec = codec
         params.selected_resolution = resolution
+        params.selected_encoder = encoder
+        params.selected_slices = codec.slices_for(resolution, cls.SLICES)
+
+        params.selected_audio_codec, params.selected_audio_mode = cls._select_audio_codec(params)
+        if params.selected_audio_codec is not None:
+            print('Audio: %s, %d Hz, %d channels' % (params.selected_audio_codec.format,
+                                                    params.selected_audio_mode[0],
+                                                    params.selected_audio_mode[2]))
+
+    @classmethod
+    def _find_aac_encoder(cls):
+        for name in cls.AAC_ENCODERS:
+            if Gst.ElementFactory.find(name) is not None:
+                return name
+        return None
+
+    @staticmethod
+    def _lpcm_supported():
+        # Only newer mpegtsmux versions can carry LPCM
+        factory = Gst.ElementFactory.find('mpegtsmux')
+        lpcm = Gst.Caps.from_string('audio/x-lpcm')
+        for template in factory.get_static_pad_templates():
+            if template.direction == Gst.PadDirection.SINK and template.get_caps().can_intersect(lpcm):
+                return True
+        return False
+
+    @staticmethod
+    def _audio_elements_available(fmt):
+        # Everything _build_audio needs besides the encoder
+        names = ['pulsesrc', 'audioconvert', 'audioresample']
+        names.append('aacparse' if fmt == 'AAC' else 'capssetter')
+        missing = [name for name in names if Gst.ElementFactory.find(name) is None]
+        if missing:
+            print('WARNING: Cannot stream %s audio, missing %s' % (fmt, ', '.join(missing)))
+        return not missing
+
+    @classmethod
+    def _select_audio_codec(cls, params):
+        """Returns the (codec, mode) of the sink to stream audio in, or
+        (None, None) if no audio can be produced. Only formats the pipeline
+        can build are considered, as they are announced in M4."""
+        for fmt in cls.AUDIO_FORMATS:
+            if not cls._audio_elements_available(fmt):
+                continue
+            if fmt == 'AAC' and cls._find_aac_encoder() is None:
+                continue
+            if fmt == 'LPCM' and not cls._lpcm_supported():
+                continue
+
+            for codec in params.audio_codecs:
+                if codec.format != fmt:
+                    continue
+                # Prefer plain 48 kHz stereo
+                mode = codec.find_mode(48000, 2) or codec.find_mode()
+                if mode is not None:
+                    return codec, mode
+
+        return None, None
+
+    @classmethod
+    def wfd_media_key(cls, params):
+        """Returns a string identifying the encoded stream for the selected
+        parameters. Sinks with the same key can share one media."""
+        cls.wfd_select_codecs(params)
+        return params.media_key()
 
     def wfd_configure(self, params):
-        self.wfd_select_codecs(params)
+        key = self.wfd_media_key(params)
+        if key == self.configured_key:
+            # Prebuilt media, or shared media that is already streaming to
+            # another sink
+            print('Using already configured media %s' % key)
+            if self.get_status() == GstRtspServer.RTSPMediaStatus.PREPARED:
+                # The new sink cannot decode anything before the next IDR
+                self.force_keyframe()
+            return
+        self.configured_key = key
+
+        if params.selected_encoder != self.encoder_name:
+            self._replace_encoder(params.selected_encoder)
+
+        self._apply_mode(params)
+
+        if params.selected_audio_codec is not None and self.audio_encoder is None:
+            self._build_audio(params.selected_audio_codec, params.selected_audio_mode)
+
+    def wfd_reconfigure(self, params):
+        """Switch a streaming media to the mode currently selected in params.
+
+        Data flow into the encoder is blocked while the caps and the encoder
+        are reconfigured, the pipeline keeps running and the payloader (and
+        with it the SSRC) stays the same. The new caps cause the encoder to
+        start with a keyframe. The encoder is recreated if the H.264 profile
+        changes, as the profile is fixed once the encoder started."""
+        if self.is_shared():
+            print('ERROR: Cannot change the mode of a media shared between sinks')
+            return False
+
+        self.configured_key = self.wfd_media_key(params)
+
+        def blocked(pad, info):
+            if params.selected_codec.profile != self.codec_profile:
+                self._replace_encoder(self.encoder_name)
+            self._apply_mode(params)
+            return Gst.PadProbeReturn.REMOVE
+
+        self.size_filter.get_static_pad('src').add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM, blocked)
+        # The probe only fires with the next buffer, do not let the frame
+        # skipper hold it back on a static desktop
+        self.frame_skipper.refresh()
+        return True
 
+    def _apply_mode(self, params):
         codec = params.selected_codec
         resolution = params.selected_resolution
+        profile = encoders.PROFILES[self.PROFILE]
 
-        # TODO: Fixup the GstFramerate object in introspection data, we need to
-        #       set it through from_string as is.
-        caps = Gst.Caps.from_string("video/x-raw,framerate=%d/1" % resolution[2])
-        caps.set_value("width", resolution[0])
-        caps.set_value("height", resolution[1])
-
-        self.size_filter.props.caps = caps
+        self._set_filter_caps(*resolution[:3])
+        self.codec_profile = codec.profile
 
-        if self.ENCODER == 'openh264':
+        if self.encoder_name == 'openh264':
             # Do we need to setup more constraints here?
             self.encoder.props.enable_frame_skip = codec.frame_skipping_allowed
             self.encoder.props.max_bitrate = codec.max_vcl_bitrate_kbit * 1024
-            # XXX: Should be set in relation to both the codec bitrate and wifi throughput
-            self.encoder.props.bitrate = self.encoder.props.max_bitrate
-            self.encoder.props.num_slices = codec.num_slices
-            #self.encoder.gop_size = 0
-        else:
-            # x264
+            self.encoder.props.gop_size = resolution[2] * profile['gop']
+        elif self.encoder_name == 'x264':
             if codec.profile == 'CHP':
                 self.encoder.load_preset('Profile High')
             else:
@@ -113,133 +486,411 @@ class WFDMedia(GstRtspServer.RTSPMedia):
             setattr(self.encoder.props, "pass", "cbr")
             self.encoder.props.b_adapt = False
             self.encoder.props.bframes = 0
-            self.encoder.props.key_int_max = resolution[2]
-            #self.encoder.props.key_int_max = 1
-            #self.encoder.props.speed_preset = "faster"
-            #self.encoder.props.tune = "zerolatency"
+            # tune, speed-preset, intra-refresh and lookahead come from the profile
+            self.encoder.props.key_int_max = resolution[2] * profile['gop']
             self.encoder.props.interlaced = resolution[3]
-            self.encoder.props.bitrate = codec.max_vcl_bitrate_kbit
-            self.encoder.props.rc_lookahead = 0
             self.encoder.props.qos = True
-            #self.encoder.props.intra_refresh = True
+        else:
+            # VA-API
+            self.encoder.props.key_int_max = resolution[2] * profile['gop']
+
+        encoders.set_slices(self.encoder, self.encoder_name, params.selected_slices)
+        encoders.set_threads(self.encoder, self.encoder_name, self.ENCODER_THREADS, profile['threading'],
+                             params.selected_slices)
 
+        if self.FRAME_SKIP:
+            self.frame_skipper.set_interval(codec.max_skip_interval())
 
-        # Unlink all pads that might be connected to the interlacer
-        #  convert (-> interlace) -> encoder
-        self.convert.unlink(self.encoder)
-        self.convert.unlink(self.interlace)
+        # Start at the maximum of the codec, the controller adapts it to the
+        # wifi throughput using the RTCP receiver reports. A mode change keeps
+        # the adapted bitrate, the link did not get any better.
+        if self.bitrate_controller is None:
+            self.bitrate_controller = bitrate.BitrateController(codec.max_vcl_bitrate_kbit, self.set_bitrate)
+        else:
+            self.bitrate_controller.set_limits(codec.max_vcl_bitrate_kbit)
+        self.set_bitrate(self.bitrate_controller.bitrate)
+
+        # Unlink all pads that might be connected to the interlacer, this is
+        # only safe while the size filter src pad is blocked (or not
+        # streaming).
+        #  size filter (-> interlace) -> encoder
+        self.size_filter.unlink(self.encoder)
+        self.size_filter.unlink(self.interlace)
         self.interlace.unlink(self.encoder)
         if resolution[3]:
             # Insert the interlace
-            self.convert.link(self.interlace)
+            self.size_filter.link(self.interlace)
             self.interlace.link(self.encoder)
         else:
             # Relink directly
-            self.convert.link(self.encoder)
+            self.size_filter.link(self.encoder)
 
-        print('Configured video to %dx%dpx, framerate: %d, interlaced: %d, frameskip: %d, max-bitrate: %d kbit/s, bitrate: %d kbit/s' % (resolution[0], resolution[1], resolution[2], int(resolution[3]), int(codec.frame_skipping_allowed), codec.max_vcl_bitrate_kbit, codec.max_vcl_bitrate_kbit))
+        print('Configured video to %dx%dpx, framerate: %d, interlaced: %d, frameskip: %d, slices: %d, max-bitrate: %d kbit/s, bitrate: %d kbit/s' % (resolution[0], resolution[1], resolution[2], int(resolution[3]), int(codec.frame_skipping_allowed), params.selected_slices, codec.max_vcl_bitrate_kbit, self.bitrate_controller.bitrate))
 
-    def force_keyframe(self):
-        return
+    def set_tcp_socket(self, socket):
+        """Watch the socket of a TCP interleaved transport and drop video
+        rather than queueing it when the connection backs up."""
+        if self.is_shared():
+            print('WARNING: Not limiting the TCP send queue of a shared media')
+            return
 
-        # nothing …
-        clock = self.get_clock()
-        now = clock.get_time()
+        self._tcp_fd = socket.get_fd()
+        self.parse.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self._tcp_backpressure)
+
+    def _tcp_send_queue(self):
+        # Bytes not yet acknowledged by the sink
+        try:
+            return struct.unpack('i', fcntl.ioctl(self._tcp_fd, termios.TIOCOUTQ, b'\0' * 4))[0]
+        except OSError:
+            return 0
+
+    def _tcp_backpressure(self, pad, info):
+        # With alignment=nal a frame is several buffers (SPS/PPS and every
+        # slice), so only decide at the start of a frame and drop or pass all
+        # of its buffers. Later NALs of a frame may come without a PTS.
+        buf = info.get_buffer()
+        if buf.pts != Gst.CLOCK_TIME_NONE and buf.pts != self._tcp_frame_pts:
+            self._tcp_frame_pts = buf.pts
+            self._tcp_drop_frame = self._tcp_should_drop(not buf.has_flags(Gst.BufferFlags.DELTA_UNIT))
+            if self._tcp_drop_frame:
+                self.tcp_dropped_frames += 1
+
+        if not self._tcp_drop_frame:
+            return Gst.PadProbeReturn.OK
+        self.tcp_dropped_bytes += buf.get_size()
+        return Gst.PadProbeReturn.DROP
+
+    def _tcp_should_drop(self, keyframe):
+        self.tcp_queued = self._tcp_send_queue()
+        bitrate = self.bitrate_controller.bitrate if self.bitrate_controller is not None else self.DEFAULT_BITRATE
+        limit = bitrate * 1000 / 8 * self.TCP_MAX_DELAY
+
+        if not self._tcp_dropping:
+            if self.tcp_queued <= limit:
+                return False
+            print('WARNING: TCP connection is backing up (%d bytes queued), dropping video' % self.tcp_queued)
+            self._tcp_dropping = True
+            self._tcp_keyframe_requested = False
+        elif self.tcp_queued <= limit / 2:
+            # Drained, resume with the next keyframe (and ask for one)
+            if keyframe:
+                self._tcp_dropping = False
+                print('INFO: Resuming video after dropping %d frames' % self.tcp_dropped_frames)
+                return False
+            if not self._tcp_keyframe_requested:
+                self._tcp_keyframe_requested = True
+                # Rate limited like the requests of the sink, from the main loop
+                GLib.idle_add(self.force_keyframe)
 
-        force_keyframe_event = GstVideo.video_event_new_downstream_force_key_unit(now, now, now, True, 0)
-        self.source.send_event(force_keyframe_event)
-        #self.encoder.gop_size = 0
+        return True
 
-    def _build_pipeline(self, wfdbin):
-        self.source = Gst.ElementFactory.make("videotestsrc")
-        self.source.props.is_live = True
-        self.source.props.do_timestamp = True
-        wfdbin.add(self.source)
+    def force_keyframe(self):
+        self.idr_requests += 1
+        if self._keyframe_pending:
+            return
 
-        self.size_filter = Gst.ElementFactory.make("capsfilter")
+        delay = self._last_keyframe + self.KEYFRAME_MIN_INTERVAL - time.monotonic()
+        if delay > 0:
+            # Rate limit, send one keyframe once the interval has passed
+            self._keyframe_pending = True
+            GLib.timeout_add(int(delay * 1000) + 1, self._send_force_key_unit)
+        else:
+            self._send_force_key_unit()
+
+    def _send_force_key_unit(self):
+        self._keyframe_pending = False
+        self._last_keyframe = time.monotonic()
+        self.idr_sent += 1
+
+        # Ask the encoder for an IDR frame as soon as possible, h264parse
+        # inserts SPS/PPS in front of it.
+        event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, self.idr_sent)
+        self.encoder.get_static_pad('src').send_event(event)
+        # The keyframe is only produced with the next encoded frame
+        self.frame_skipper.refresh()
+
+        return False
+
+    def _build_audio(self, codec, mode):
+        """Add the audio branch feeding the muxer. This happens only once the
+        audio codec has been negotiated."""
+        rate, bits, channels = mode[:3]
+        elements = []
+
+        source = Gst.ElementFactory.make('pulsesrc')
+        if source is None:
+            print('ERROR: Cannot capture audio, pulsesrc is missing')
+            return
+        source.props.device = self.AUDIO_DEVICE
+        # Keep buffering small, so that audio does not raise the latency of
+        # the (shared) pipeline above the video latency.
+        source.props.buffer_time = 20000
+        source.props.latency_time = 10000
+        # Use the pipeline (system) clock, which is also the NTP time source
+        # of the rtpbin, so audio and video share one timebase.
+        source.props.provide_clock = False
+        source.props.slave_method = 're-timestamp'
+        elements.append(source)
+
+        elements.append(Gst.ElementFactory.make('audioconvert'))
+        elements.append(Gst.ElementFactory.make('audioresample'))
+
+        filt = Gst.ElementFactory.make('capsfilter')
+        if codec.format == 'LPCM':
+            caps = 'audio/x-raw,format=S16BE,layout=interleaved,rate=%d,channels=%d' % (rate, channels)
+        else:
+            caps = 'audio/x-raw,rate=%d,channels=%d' % (rate, channels)
+        filt.props.caps = Gst.Caps.from_string(caps)
+        elements.append(filt)
+
+        if codec.format == 'AAC':
+            self.audio_encoder = Gst.ElementFactory.make(self._find_aac_encoder())
+            self.audio_encoder.props.bitrate = 128000 * channels // 2
+            elements.append(self.audio_encoder)
+            elements.append(Gst.ElementFactory.make('aacparse'))
+            filt = Gst.ElementFactory.make('capsfilter')
+            filt.props.caps = Gst.Caps.from_string('audio/mpeg,mpegversion=4,stream-format=adts')
+            elements.append(filt)
+        else:
+            # Raw big endian PCM, relabeled so that the muxer carries it as LPCM
+            self.audio_encoder = Gst.ElementFactory.make('capssetter')
+            self.audio_encoder.props.replace = True
+            self.audio_encoder.props.caps = Gst.Caps.from_string(
+                'audio/x-lpcm,width=%d,rate=%d,channels=%d' % (bits, rate, channels))
+            elements.append(self.audio_encoder)
+
+        wfdbin = self.encoder.get_parent()
+        prev = None
+        for element in elements:
+            wfdbin.add(element)
+            if prev is not None:
+                assert prev.link(element)
+            prev = element
+        assert prev.link_pads("src", self.mpegmux, "sink_%d" % self.AUDIO_PID)
+
+        self._measure_mux_input(self.mpegmux.get_static_pad("sink_%d" % self.AUDIO_PID), 'audio')
+
+        for element in elements:
+            element.sync_state_with_parent()
+
+    def _measure_mux_input(self, pad, stream):
+        def probe(pad, info):
+            element = pad.get_parent_element()
+            clock = element.get_clock()
+            buf = info.get_buffer()
+            if clock is not None and buf.pts != Gst.CLOCK_TIME_NONE:
+                now = clock.get_time() - element.get_base_time()
+                self._mux_input_delay[stream] = now - buf.pts
+            return Gst.PadProbeReturn.OK
+
+        pad.add_probe(Gst.PadProbeType.BUFFER, probe)
+
+    def av_skew(self):
+        """Returns how much later audio arrives at the muxer than video (in
+        ms, negative if audio is ahead), or None without an audio stream."""
+        try:
+            return (self._mux_input_delay['audio'] - self._mux_input_delay['video']) / Gst.MSECOND
+        except KeyError:
+            return None
+
+    def _attach_encoder_probes(self):
+        def encoder_in(pad, info):
+            pts = info.get_buffer().pts
+            if pts != Gst.CLOCK_TIME_NONE:
+                self._encoder_pending.append(pts)
+            return Gst.PadProbeReturn.OK
+
+        def encoder_out(pad, info):
+            # Without B-frames frames leave in order, so older frames that
+            # are still pending were dropped by the encoder.
+            pts = info.get_buffer().pts
+            pending = self._encoder_pending
+            while pending and pts != Gst.CLOCK_TIME_NONE and pending[0] <= pts:
+                pending.popleft()
+
+            self.encoded_frames += 1
+            self.encoded_bytes += info.get_buffer().get_size()
+
+            # Rates over windows of (at least) one second
+            now = time.monotonic()
+            start, frames, size = self._rate_window
+            if now - start >= 1:
+                self.encoded_fps = (self.encoded_frames - frames) / (now - start)
+                self.encoded_bitrate = (self.encoded_bytes - size) * 8 / 1000 / (now - start)
+                self._rate_window = (now, self.encoded_frames, self.encoded_bytes)
+            return Gst.PadProbeReturn.OK
+
+        # A replaced encoder starts out empty
+        self._encoder_pending.clear()
+        if self.profiler is not None and 'encoder' in self.profiler.elements:
+            self.profiler.add('encoder', self.encoder)
+        self.encoder.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, encoder_in)
+        self.encoder.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, encoder_out)
+
+    def metrics(self):
+        """Returns the current statistics of the stream, see metrics.py"""
+        result = [
+            metrics.gauge('wfd_encoded_fps', 'Frames per second leaving the encoder', self.encoded_fps),
+            metrics.gauge('wfd_encoded_bitrate_kbit', 'Actual encoded video bitrate (kbit/s)', self.encoded_bitrate),
+            metrics.counter('wfd_encoded_frames_total', 'Frames encoded', self.encoded_frames),
+            metrics.counter('wfd_encoded_bytes_total', 'Bytes of encoded video', self.encoded_bytes),
+            metrics.gauge('wfd_encoder_queue_frames', 'Frames inside the encoder', len(self._encoder_pending)),
+            metrics.counter('wfd_captured_frames_total', 'Frames captured', self.capture.frames),
+            metrics.counter('wfd_skipped_frames_total', 'Captured frames not encoded because the content did not change', self.frame_skipper.skipped),
+            metrics.counter('wfd_idr_requests_total', 'Keyframes requested by the sink (or to resume dropped video)', self.idr_requests),
+            metrics.counter('wfd_idr_sent_total', 'Keyframes forced in the encoder', self.idr_sent),
+            metrics.gauge('wfd_av_skew_ms', 'Audio arrival at the muxer relative to video (ms)', self.av_skew()),
+        ]
+
+        controller = self.bitrate_controller
+        if controller is not None:
+            result += [
+                metrics.gauge('wfd_max_bitrate_kbit', 'Maximum VCL bitrate of the negotiated codec (kbit/s)', controller.max_bitrate),
+                metrics.gauge('wfd_target_bitrate_kbit', 'Encoder target bitrate (kbit/s)', controller.bitrate),
+                metrics.gauge('wfd_rtcp_loss_ratio', 'Fraction lost from the last receiver report', controller.loss),
+                metrics.gauge('wfd_rtcp_jitter_seconds', 'Interarrival jitter from the last receiver report', controller.jitter),
+                metrics.gauge('wfd_rtcp_rtt_seconds', 'Round trip time from the last receiver report', controller.rtt),
+                metrics.counter('wfd_rtcp_reports_total', 'Receiver reports received', controller.reports),
+            ]
+
+        if self._tcp_fd is not None:
+            result += [
+                metrics.gauge('wfd_tcp_queued_bytes', 'Bytes queued in the TCP socket of the transport', self.tcp_queued),
+                metrics.counter('wfd_tcp_dropped_frames_total', 'Video frames dropped because the TCP connection backed up', self.tcp_dropped_frames),
+                metrics.counter('wfd_tcp_dropped_bytes_total', 'Encoded video bytes dropped because the TCP connection backed up', self.tcp_dropped_bytes),
+            ]
+
+        if self.fec_encoder is not None:
+            result.append(metrics.gauge('wfd_fec_percentage', 'FEC packets in percent of the media packets', self.fec_encoder.props.percentage))
+
+        if self.rtp_stats is not None:
+            result += [
+                metrics.counter('wfd_rtp_packets_total', 'RTP packets sent', self.rtp_stats.get_value('packets-sent')),
+                metrics.counter('wfd_rtp_bytes_total', 'RTP payload bytes sent', self.rtp_stats.get_value('octets-sent')),
+                metrics.counter('wfd_rtcp_nack_total', 'Retransmission requests (NACK) received', self.rtp_stats.get_value('recv-nack-count')),
+            ]
+
+        return result
+
+    def _make_convert(self):
+        # videoconvertscale is new in GStreamer 1.22, before that the same
+        # is done by two elements.
+        convert = Gst.ElementFactory.make("videoconvertscale")
+        if convert is not None:
+            convert.props.n_threads = self.CONVERT_THREADS
+            return convert
+
+        convert = Gst.Bin.new("convert")
+        scale = Gst.ElementFactory.make("videoscale")
+        colorspace = Gst.ElementFactory.make("videoconvert")
+        for element in (scale, colorspace):
+            element.props.n_threads = self.CONVERT_THREADS
+            convert.add(element)
+        assert scale.link(colorspace)
+        convert.add_pad(Gst.GhostPad.new("sink", scale.get_static_pad("sink")))
+        convert.add_pad(Gst.GhostPad.new("src", colorspace.get_static_pad("src")))
+        return convert
+
+    def _set_filter_caps(self, width, height, framerate):
         # TODO: Fixup the GstFramerate object in introspection data, we need to
         #       set it through from_string as is.
-        caps = Gst.Caps.from_string("video/x-raw,framerate=30/1")
-        caps.set_value("height", 1080)
-        caps.set_value("width", 1920)
+        caps = Gst.Caps.from_string("video/x-raw,format=%s,pixel-aspect-ratio=1/1,framerate=%d/1" % (
+            encoders.FORMATS[self.encoder_name], framerate))
+        caps.set_value("width", width)
+        caps.set_value("height", height)
         self.size_filter.props.caps = caps
 
-        wfdbin.add(self.size_filter)
-        assert self.source.link(self.size_filter)
+    def _replace_encoder(self, name):
+        encoder = encoders.make_encoder(name, self.PROFILE)
+        if encoder is None:
+            print('ERROR: Encoder %s is not available, keeping %s' % (name, self.encoder_name))
+            return
+
+        wfdbin = self.encoder.get_parent()
+        # Everything upstream is relinked by wfd_configure
+        self.size_filter.unlink(self.encoder)
+        self.interlace.unlink(self.encoder)
+        self.encoder.unlink(self.parse)
+        self.encoder.set_state(Gst.State.NULL)
+        wfdbin.remove(self.encoder)
 
-        # Convert video to correct color space
-        self.convert = Gst.ElementFactory.make("autovideoconvert")
+        self.encoder = encoder
+        self.encoder_name = name
+        wfdbin.add(self.encoder)
+        assert self.encoder.link(self.parse)
+        self._attach_encoder_probes()
+        self.encoder.sync_state_with_parent()
+
+    def _build_pipeline(self, wfdbin):
+        self.capture = capture.make_capture_source(self.SOURCES)
+        self.source = self.capture.build(wfdbin)
+        self.frame_skipper = capture.FrameSkipper(self.capture)
+        if self.ENCODER_AFFINITY is not None:
+            encoders.pin_streaming_thread(self.source.get_static_pad('src'), self.ENCODER_AFFINITY)
+        print('Capturing video from %s' % self.capture.NAME)
+
+        # Scale and convert in one pass. The size filter behind it requests
+        # the native format of the encoder, so sources that can produce it
+        # (and the negotiated size) directly are passed through untouched.
+        self.convert = self._make_convert()
         wfdbin.add(self.convert)
-        assert self.size_filter.link(self.convert)
+        assert self.source.link(self.convert)
+
+        self.size_filter = Gst.ElementFactory.make("capsfilter")
+        wfdbin.add(self.size_filter)
+        assert self.convert.link(self.size_filter)
 
         self.interlace = Gst.ElementFactory.make("interlace")
         self.interlace.props.field_pattern = '1:1'
         wfdbin.add(self.interlace)
 
+        # The final encoder is only known once the mode has been negotiated,
+        # start out with the first available one.
+        self.encoder_name = None
+        self.encoder = None
         for encoder in self.ENCODERS:
-            if encoder == 'openh264':
-                # Encode video with H264 using openh264
-                self.encoder = Gst.ElementFactory.make('openh264enc')
-                if self.encoder is None:
-                    continue
-
-                # Disable multi-threading (we don't need it, but also: https://github.com/cisco/openh264/issues/2618)
-                self.encoder.props.multi_thread = 1
-                self.encoder.props.usage_type = "screen"
-                self.encoder.props.slice_mode = "n-slices"
-                self.encoder.props.num_slices = 1
-                self.encoder.props.rate_control = 'bitrate'
-                self.encoder.props.gop_size = 30
-                self.encoder.props.enable_frame_skip = False
-                #self.encoder.props.background_detection = False
-                #self.encoder.props.adaptive_quantization = False
-                #self.encoder.props.max_slice_size = 5000
-                #self.encoder.props.complexity = 0
-                #self.encoder.props.deblocking = "off"
-            else:
-                self.encoder = Gst.ElementFactory.make('x264enc')
-                if self.encoder is None:
-                    continue
-
-                self.encoder.load_preset('Profile High')
-
-            # This is a bit of a hack, we should check that the element exists
-            # earlier.
-            self.__class__.ENCODER = encoder
-            break
+            self.encoder = encoders.make_encoder(encoder, self.PROFILE)
+            if self.encoder is not None:
+                self.encoder_name = encoder
+                break
 
         if self.encoder is None:
             raise AssertionError("No encoder found, cannot stream video!")
 
+        self._set_filter_caps(1920, 1080, 30)
         wfdbin.add(self.encoder)
-        assert self.convert.link(self.encoder)
+        assert self.size_filter.link(self.encoder)
 
         # This is from miraclecast, I am not sure whether parsing the h264
         # stream is really neccessary.
-        parse = Gst.ElementFactory.make("h264parse")
-        #parse.props.disable_passthrough = True
-        # What is a good value for config-interval? Does this even do anything?
-        #parse.props.config_interval = 1
-        wfdbin.add(parse)
-        assert self.encoder.link(parse)
+        self.parse = Gst.ElementFactory.make("h264parse")
+        #self.parse.props.disable_passthrough = True
+        # Send SPS/PPS with every IDR frame, so that a sink can recover from
+        # packet loss with any keyframe (including forced ones).
+        self.parse.props.config_interval = -1
+        wfdbin.add(self.parse)
+        assert self.encoder.link(self.parse)
+        self._attach_encoder_probes()
 
         filt = Gst.ElementFactory.make("capsfilter")
         caps = Gst.Caps.from_string("video/x-h264,alignment=nal,stream-format=byte-stream")
         filt.props.caps = caps
         wfdbin.add(filt)
-        assert parse.link(filt)
-
-        mpegmux = Gst.ElementFactory.make("mpegtsmux")
-        mpegmux.props.alignment = 7 # For UDP streaming according to documentation
-        wfdbin.add(mpegmux)
-        assert filt.link_pads("src", mpegmux, "sink_%d" % 0x1011)
-        payloader = Gst.ElementFactory.make("rtpmp2tpay", "pay0")
+        assert self.parse.link(filt)
+
+        self.mpegmux = Gst.ElementFactory.make("mpegtsmux")
+        self.mpegmux.props.alignment = 7 # For UDP streaming according to documentation
+        self.mpegmux.props.latency = encoders.PROFILES[self.PROFILE]['mux_latency']
+        wfdbin.add(self.mpegmux)
+        assert filt.link_pads("src", self.mpegmux, "sink_%d" % 0x1011)
+        self._measure_mux_input(self.mpegmux.get_static_pad("sink_%d" % 0x1011), 'video')
+        self.payloader = Gst.ElementFactory.make("rtpmp2tpay", "pay0")
         # Use a fixed SSRC as it must never change (e.g. when changing resolutions)
-        payloader.props.ssrc = 0x1
+        self.payloader.props.ssrc = 0x1
         # Perfect means in relation to the input buffers, but we want the proper
         # clock from the time the pacet was sent.
-        payloader.props.perfect_rtptime = False
-        wfdbin.add(payloader)
-        assert mpegmux.link(payloader)
+        self.payloader.props.perfect_rtptime = False
+        wfdbin.add(self.payloader)
+        assert self.mpegmux.link(self.payloader)
 
 
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
 import gi
+import copy
+import threading
+import time
 from enum import Enum
 
 gi.require_version('Gst', '1.0')
@@ -8,52 +11,82 @@ gi.require_version('GstRtsp', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 
 from gi.repository import GLib
+from gi.repository import GObject
 from gi.repository import Gst
 from gi.repository import GstRtsp
 from gi.repository import GstRtspServer
 
+import cache
+import encoders
+import metrics
 from rtp import WFDMedia
-
-
-CONNECTOR_TYPE = {
-     0: 'VGA',
-     1: 'S-VIDEO',
-     2: 'Composite Video',
-     3: 'Component Video',
-     4: 'DVI',
-     5: 'HDMI',
-#     6: Reserved,
-     7: 'Wi-Fi Display',
-     8: 'Japanese D',
-     9: 'SDI',
-    10: 'DP',
-#    11: Reserved,
-    12: 'UDI',
-   255: 'Unknown'
-}
+from wfdparams import WFDParams
 
 
 class WFDMediaFactory(GstRtspServer.RTSPMediaFactory):
 
     __gtype_name__ = "WFDMediaFactory"
 
+    # Share one encoding pipeline between all sinks that negotiated the same
+    # codec and mode (mirroring to several displays). The RTP stream is then
+    # fanned out to every sink by the RTSP server.
+    SHARED = False
+
+    # Time (ms) sent packets are kept for retransmission (RFC 4588) on NACK
+    # requests. Only sinks using the AVPF profile send these.
+    RETRANSMISSION_TIME = 200
+
+    # Number of prebuilt media kept for sinks that are still negotiating,
+    # see prewarm
+    POOL_SIZE = 2
+
     def __init__(self):
         super().__init__()
 
         self.set_media_gtype(WFDMedia)
-        self.props.latency = 40
+        self.set_shared(self.SHARED)
+        self.props.latency = encoders.PROFILES[WFDMedia.PROFILE]['latency']
         self.props.suspend_mode = GstRtspServer.RTSPSuspendMode.RESET
-        self.props.profiles = GstRtsp.RTSPProfile.AVP
+        self.props.profiles = GstRtsp.RTSPProfile.AVP | GstRtsp.RTSPProfile.AVPF
         self.props.transport_mode = GstRtsp.RTSPTransMode.RTP
         self.props.protocols = GstRtsp.RTSPLowerTrans.UDP | GstRtsp.RTSPLowerTrans.TCP
+        self.set_retransmission_time(self.RETRANSMISSION_TIME * Gst.MSECOND)
         # Cannot set here, are they needed?
-        #  * do-retransmission
         #  * ntp-time-source
         #  * buffer-mode
         #  * max-misorder-time
 
-    def do_construct(self, url):
-        print("constructing for URL %s" % url.get_request_uri())
+        # (media key, media, owner) of prebuilt media, oldest first, and the
+        # owner of every media key being built. Media are built in a thread
+        # of their own and claimed in the thread of the requesting client.
+        self._pool = []
+        self._building = {}
+        self._pool_lock = threading.Lock()
+
+    @staticmethod
+    def _client_media_key():
+        """The media key of the client whose request is being handled, or
+        None outside of a request."""
+        ctx = GstRtspServer.RTSPContext.get_current()
+        if ctx is None or not isinstance(ctx.client, WFDClient):
+            return None
+        return WFDMedia.wfd_media_key(ctx.client.params)
+
+    def do_gen_key(self, url):
+        key = GstRtspServer.RTSPMediaFactory.do_gen_key(self, url)
+        if not self.is_shared():
+            return key
+
+        # All sinks use the same URL, so add the negotiated parameters of the
+        # requesting client. Sinks with different parameters get their own
+        # media (and encoder), compatible ones are attached to the same.
+        media_key = self._client_media_key()
+        if media_key is None:
+            return key
+
+        return '%s#%s' % (key, media_key)
+
+    def _construct_media(self):
         wfd_media = WFDMedia(transport_mode=self.props.transport_mode)
         pipeline = Gst.Pipeline.new('media-pipeline')
         wfd_media.take_pipeline(pipeline)
@@ -63,9 +96,72 @@ class WFDMediaFactory(GstRtspServer.RTSPMediaFactory):
         # in the DESCRIBE request, but we never get such a request with WFD
         stream = wfd_media.get_stream(0)
         stream.set_control('streamid=0')
-        
+
         return wfd_media
 
+    def prewarm(self, params, owner=None):
+        """Build a media for the mode selected in params ahead of SETUP. The
+        elements are created, the encoder and caps configured and the
+        pipeline brought to READY (opening the capture source), so that
+        do_construct only has to hand it out.
+
+        The media is built in a separate thread, the main loop keeps handling
+        the RTSP messages meanwhile. Media built for owner are dropped again
+        by release(owner)."""
+        key = WFDMedia.wfd_media_key(params)
+        with self._pool_lock:
+            if key in self._building or any(k == key for k, media, o in self._pool):
+                return
+            self._building[key] = owner
+
+        threading.Thread(target=self._build, args=(key, copy.copy(params), owner),
+                         name='prewarm', daemon=True).start()
+
+    def _build(self, key, params, owner):
+        media = self._construct_media()
+        media.wfd_configure(params)
+        media.get_element().set_state(Gst.State.READY)
+
+        with self._pool_lock:
+            if key not in self._building or self._building[key] is not owner:
+                # Released while building
+                evicted = [(key, media, owner)]
+            else:
+                del self._building[key]
+                self._pool.append((key, media, owner))
+                evicted = []
+                while len(self._pool) > self.POOL_SIZE:
+                    evicted.append(self._pool.pop(0))
+                print('INFO: Prebuilt media for %s' % key)
+
+        for key, media, owner in evicted:
+            media.get_element().set_state(Gst.State.NULL)
+
+    def release(self, owner):
+        """Drop the prebuilt media of owner (e.g. a disconnected client), so
+        they do not keep the capture source open."""
+        with self._pool_lock:
+            released = [entry for entry in self._pool if entry[2] is owner]
+            self._pool = [entry for entry in self._pool if entry[2] is not owner]
+            for key in [k for k, o in self._building.items() if o is owner]:
+                del self._building[key]
+
+        for key, media, owner in released:
+            print('INFO: Dropping prebuilt media for %s' % key)
+            media.get_element().set_state(Gst.State.NULL)
+
+    def do_construct(self, url):
+        print("constructing for URL %s" % url.get_request_uri())
+        key = self._client_media_key()
+        with self._pool_lock:
+            for i, (k, media, owner) in enumerate(self._pool):
+                if k == key:
+                    del self._pool[i]
+                    print('INFO: Using prebuilt media for %s' % key)
+                    return media
+
+        return self._construct_media()
+
     def do_configure(self, media):
         GstRtspServer.RTSPMediaFactory.do_configure(self, media)
 
@@ -81,403 +177,188 @@ class InitState(Enum):
     DONE = 9999
 
 
-class VideoCodec:
-    # Video modes: width, height, refresh rate, interlaced
-    CEA = [
-        ( 640,  480, 60, False),
-        ( 720,  480, 60, False),
-        ( 720,  480, 60, True),
-        ( 720,  576, 50, False),
-        ( 720,  576, 50, True),
-        (1280,  720, 30, False),
-        (1280,  720, 60, False),
-        (1920, 1080, 30, False),
-        (1920, 1080, 60, False),
-        (1920, 1080, 60, True),
-        (1290,  720, 25, False),
-        (1280,  720, 50, False),
-        (1920, 1080, 25, False),
-        (1920, 1080, 50, False),
-        (1920, 1080, 50, True),
-        (1280,  720, 24, False),
-        (1920, 1080, 25, False),
-    ]
-
-    VESA = [
-        ( 800,  600, 30, False),
-        ( 800,  600, 60, False),
-        (1024,  768, 30, False),
-        (1024,  768, 60, False),
-        (1152,  864, 30, False),
-        (1152,  864, 60, False),
-        (1280,  768, 30, False),
-        (1280,  768, 60, False),
-        (1280,  800, 30, False),
-        (1280,  800, 60, False),
-        (1360,  768, 30, False),
-        (1360,  768, 60, False),
-        (1366,  768, 30, False),
-        (1366,  768, 60, False),
-        (1280, 1024, 30, False),
-        (1280, 1024, 60, False),
-        (1400, 1050, 30, False),
-        (1400, 1050, 60, False),
-        (1440,  900, 30, False),
-        (1440,  900, 60, False),
-        (1600,  900, 30, False),
-        (1600,  900, 60, False),
-        (1600, 1200, 30, False),
-        (1600, 1200, 60, False),
-        (1680, 1024, 30, False),
-        (1680, 1024, 30, False),
-        (1680, 1050, 30, False),
-        (1680, 1050, 60, False),
-        (1920, 1200, 30, False),
-    ]
-
-    HH = [
-        (800, 480, 30, False),
-        (800, 480, 60, False),
-        (854, 480, 30, False),
-        (854, 480, 60, False),
-        (864, 480, 30, False),
-        (864, 480, 60, False),
-        (640, 360, 30, False),
-        (640, 360, 60, False),
-        (960, 540, 30, False),
-        (960, 540, 60, False),
-        (848, 480, 30, False),
-        (848, 480, 60, False),
-    ]
-
-    def __init__(self, native, descr):
-        descr = descr.split()
-        assert len(descr) == 11
-
-        self.native = None
-        try:
-            t = native & 0x7
-            i = native >> 3
-            if t == 0x0:
-                self.native = (*self.CEA[native >> 3], t, i)
-            elif t == 0x1:
-                self.native = (*self.VESA[native >> 3], t, i)
-            elif t == 0x2:
-                self.native = (*self.HH[native >> 3], t, i)
-        except IndexError:
-            print('ERROR: Native resolution with ID %02X does not exist' % native)
-            self.native = None
-
-        self._profile = int(descr[0], 16)
-        assert 0 <= self._profile <= 255
-
-        self.level = int(descr[1], 16)
-        assert 0 <= self.level <= 255
-
-        self.cea_sup = int(descr[2], 16)
-        self.vesa_sup = int(descr[3], 16)
-        self.hh_sup = int(descr[4], 16)
-
-        self.latency = int(descr[5], 16)
-
-        self.min_slice_size = int(descr[6], 16)
-        self.slice_enc_params = int(descr[7], 16)
-        self.frame_rate_ctrl_sup = int(descr[8], 16)
-
-        # We don't support this protocol, so ignore it
-        #self.max_hres = int(descr[9], 16) if descr[9] != 'none' else None
-        #self.max_vres = int(descr[10], 16) if descr[10] != 'none' else None
-
-    @property
-    def num_slices(self):
-        return (self.slice_enc_params & 0x1ff) + 1
-
-    def get_profile(self):
-        if self._profile == 0x01:
-            return 'CBP'
-        elif self._profile == 0x02:
-            return 'CHP'
-        else:
-            raise AssertionError('Unknown profile %02X' % self._profile)
-
-    def set_profile(self, value):
-        if value == 'CBP':
-            self._profile = 0x01
-        elif value == 'CHP':
-            self._profile = 0x02
-        else:
-            raise AssertionError('Unknown profile %s' % value)
-
-    profile = property(get_profile, set_profile)
-
-    @property
-    def max_vcl_bitrate_kbit(self):
-        if self.level == 1 << 0:
-            # 3.1
-            bitrate = 14000
-        elif self.level == 1 << 1:
-            # 3.2
-            bitrate = 20000
-        elif self.level == 1 << 2:
-            # 4
-            bitrate = 20000
-        elif self.level == 1 << 3:
-            # 4.1
-            bitrate = 50000
-        elif self.level == 1 << 4:
-            # 4.2
-            bitrate = 50000
-
-        if self.profile == 'CHP':
-            bitrate = int(bitrate * 1.25)
-
-        return bitrate
-
-    @property
-    def max_slices(self):
-        return self.slice_enc_params & 0x1f + 1
-
-    def get_frame_skipping_allowed(self):
-        return bool(self.frame_rate_ctrl_sup & 0x1)
-
-    def set_frame_skipping_allowed(self, value):
-        self.frame_rate_ctrl_sup = (self.frame_rate_ctrl_sup & 0xfffe) | int(bool(value))
-
-    frame_skipping_allowed = property(get_frame_skipping_allowed, set_frame_skipping_allowed)
-
-    def max_skip_interval(self):
-        """Returns the maximum time that may be skipped. Returns -1 if there
-        are no time constraints."""
-        if not self.frame_skipping_allowed:
-            return 0
-        skip = (self.frame_rate_ctrl_sup >> 1) & 0x7
-        if skip == 0:
-            return -1
-        return skip * 0.5
-
-    def _get_resolutions(self, t):
-        if t == 0x0:
-            bitfield = self.cea_sup
-            mapping = self.CEA
-        elif t == 0x1:
-            bitfield = self.vesa_sup
-            mapping = self.VESA
-        elif t == 0x2:
-            bitfield = self.hh_sup
-            mapping = self.HH
-        else:
-            raise AssertionError('Unknown resolution table')
-
-        i = 0
-        resolutions = []
-        while bitfield and i < len(mapping):
-            if bitfield & 0x1:
-                resolutions.append((*mapping[i], t, i))
-            bitfield = bitfield >> 1
-            i += 1
-
-        return resolutions
-
-    def get_resolutions(self):
-        resolutions = []
-        resolutions.extend(self._get_resolutions(0x0))
-        resolutions.extend(self._get_resolutions(0x1))
-        resolutions.extend(self._get_resolutions(0x2))
-
-        # Consider interlaced just under half the technical refresh rate
-        resolutions.sort(key=lambda x: (x[0] * x[1] * 100) + (x[2] / (int(x[3]) + 1) - int(x[3])), reverse=True)
+class SinkCache:
+    """Persistent cache of the M3 response and the selected mode for every
+    sink we have seen, keyed by the MAC address of the sink.
 
-        return resolutions
-
-    def get_native_resolution(self):
-        return self.native
-
-    def find_best_resolution(self):
-        return self.get_resolutions()[0]
-
-    def find_resolution(self, width, height, framerate=None, interlaced=None):
-        resolutions = self.get_resolutions()
-
-        for r in resolutions:
-            if r[0] != width or r[1] != height:
-                continue
-            if framerate is not None and r[2] != framerate:
-                continue
-            if interlaced is not None and r[3] != interlaced:
-                continue
-            return r
-
-        return None
-
-    def descr_for_resolution(self, r):
-        # We only support base profile
-        profile = self._profile
-        level = self.level
-
-        sup = 1 << r[5]
-        cea_sup = sup if r[4] == 0 else 0
-        vesa_sup = sup if r[4] == 1 else 0
-        hh_sup = sup if r[4] == 2 else 0
-
-        latency = 0
-
-        min_slice_size = 0
-        slice_enc_params = 0
-        # Set dynamic framerate change bit? We don't currently support this
-        frame_rate_ctrl_sup = 0x01 if self.frame_skipping_allowed else 0x00
-
-        return "00 00 %02X %02X %08X %08X %08X %02X %04X %04X %02x none none" % (
-                # static: native resolution and prefered display mode
-                profile, level,
-                cea_sup, vesa_sup, hh_sup,
-                latency, min_slice_size, slice_enc_params, frame_rate_ctrl_sup
-                # static: maximum width and height
-            )
-
-class WFDParams:
-    # Mandatory at connection time:
-    #  * wfd_client_rtp_ports
-    #  * 
-    m3_mandatory = [
-        b'wfd_client_rtp_ports',
-        b'wfd_audio_codecs',
-        b'wfd_video_formats',
-
-        # Only if supported:
-        #b'wfd_content_protection',
-    ]
-
-    m3_optional = [
-        b'wfd_3d_video_formats',
-        b'wfd_display_edid',
-        b'wfd_coupled_sink',
-        b'wfd_I2C',
-        b'wfd_standby_resume_capability',
-        b'wfd_connector_type',
-        b'wfd_uibc_capability',
-        b'wfd2_audio_codecs',
-        b'wfd2_video_codecs',
-        b'wfd2_aux_stream_formats',
-        b'wfd2_buffer_length',
-        b'wfd2_audio_playback_status',
-        b'wfd2_video_playback_status',
-        b'wfd2_cta_datablock_collection',
-    ]
+    Entries are only used with the encoders they were selected for, see
+    encoders.EncoderCapabilities.fingerprint."""
 
+    NAME = 'sinks.json'
 
     def __init__(self):
-        self.resolution = (1920, 1080)
-        self.video_codecs = []
-        self.primary_rtp_port = 16384
-        self.secondary_rtp_port = 0
-
-        # Add a basic standard codec for testing purposes
-        codec = VideoCodec(0, '01 01 00000081 00000000 00000000 00 0000 0000 00 none none')
-        self.video_codecs.append(codec)
-        self.active_codec = None
-
-    def from_sink(self, body):
-        # Try to parse (some) of the options
-        params = {}
-
-        # Params are separated by CRLF, just split on LF and strip
-        for option in body.split(b'\n'):
-            option = option.decode('ascii')
-            option = option.strip()
-            # Ignore empty lines
-            if not option:
-                continue
-            option = option.split(':', 1)
-            if len(option) != 2:
-                # XXX: Error
-                continue
-            param = option[0]
-            val = option[1].strip()
-            params[param] = val
-
-        for param, val in params.items():
-            if param == 'wfd_client_rtp_ports':
-                val = val.split()
-                assert len(val) == 4
-                self.profile = val[0]
-                assert self.profile == 'RTP/AVP/UDP;unicast'
-
-                self.primary_rtp_port = int(val[1])
-                self.secondary_rtp_port = int(val[2])
-
-                assert val[3] == 'mode=play'
-            elif param == 'wfd_video_formats':
-                self.video_codecs = []
-                if val == 'none':
-                    continue
-
-                val = val.split(maxsplit=2)
-                assert len(val) == 3
-                native = int(val[0], 16)
-                # Prefered display mode is a V1.0 only specification to
-                # figure out a good mode. However, we can just select something
-                # sane without it.
-                video_prefered_display_mode_supported = int(val[1], 16)
-                # CAE: 0, VESA: 1, HH: 2
-                assert native & 0x7 in [0x0, 0x1, 0x2]
-                assert video_prefered_display_mode_supported in [0x0, 0x1]
-
-                for c in val[2].split(','):
-                    self.video_codecs.append(VideoCodec(native, c))
-            elif param == 'wfd_audio_codecs':
-                pass
-            elif param == 'wfd_display_edid':
-                if val == 'none':
-                    # No edid (and reporting not supported)
-                    self.edid = None
-                    continue
-
-                length, edid = val.split(maxsplit=1)
-                edid = edid.strip()
-                try:
-                    length = int(length)
-                    if length == 0 and edid != "none":
-                        print('ERROR: EDID must have a value of "none" if length is zero')
+        self.sinks = cache.load(self.NAME) or {}
+        self.fingerprint = encoders.EncoderCapabilities.fingerprint()
 
-                    if len(edid) != 128 * 2 * length:
-                        print('ERROR: EDID hex string should be %d characters but is %d characters' % (128 * 2 * length, len(edid)))
-                except ValueError:
-                    print("ERROR: Could not parse EDID length")
-                    self.edid = None
-                    continue
+    @staticmethod
+    def identity(ip):
+        """Returns the identity of the sink with the given IP address, or
+        None if the MAC address is not known."""
+        try:
+            with open('/proc/net/arp') as f:
+                # IP address, HW type, Flags, HW address, Mask, Device
+                for line in f.readlines()[1:]:
+                    fields = line.split()
+                    if fields[0] == ip and int(fields[2], 16) != 0:
+                        return 'mac:' + fields[3].lower()
+        except OSError:
+            pass
+        return None
 
-                if edid == 'none':
-                    # No edid but reporting is supported
-                    self.edid = None
-                    continue
+    def lookup(self, identity):
+        """Returns WFDParams restored from the cache, or None."""
+        entry = self.sinks.get(identity) if identity else None
+        if entry is None:
+            return None
+        if entry.get('encoders') != self.fingerprint:
+            print('INFO: Encoders changed since sink %s was seen, not using its cached parameters' % identity)
+            return None
+
+        params = WFDParams()
+        params.from_sink(entry['m3'].encode('ascii'))
+
+        codec = copy.copy(params.video_codecs[entry['codec']])
+        codec.profile = entry['profile']
+        params.selected_codec = codec
+        params.selected_resolution = tuple(entry['resolution'])
+        params.selected_encoder = entry['encoder']
+        params.selected_slices = entry['slices']
+        if entry['audio'] is not None:
+            params.selected_audio_codec = params.audio_codecs[entry['audio'][0]]
+            params.selected_audio_mode = tuple(entry['audio'][1])
+        else:
+            params.selected_audio_codec = params.selected_audio_mode = None
 
-                self.edid = bytes.fromhex(edid)
+        return params
 
-    def m3_query_params(self):
-        # TODO: Query more than just the mandatory parameters!
-        params = self.m3_mandatory[:]
+    def matches(self, identity, body):
+        entry = self.sinks.get(identity) if identity else None
+        return entry is not None and entry['m3'] == body.decode('ascii')
 
-        params.append(b'wfd_display_edid')
+    def store(self, identity, body, params):
+        if identity is None:
+            return
 
-        return b'\r\n'.join(params) + b'\r\n'
+        # The selected codec may be a modified copy (with another profile for
+        # openh264), store which one it is. Prefer the codec of the same
+        # profile, sinks may report CBP and CHP with the same modes.
+        selected = params.selected_codec
+        candidates = [i for i, c in enumerate(params.video_codecs)
+                      if c.cea_sup == selected.cea_sup
+                      and c.vesa_sup == selected.vesa_sup
+                      and c.hh_sup == selected.hh_sup
+                      and c.level == selected.level]
+        codec = next((i for i in candidates if params.video_codecs[i].profile == selected.profile), candidates[0])
+        audio = None
+        if params.selected_audio_codec is not None:
+            audio = (params.audio_codecs.index(params.selected_audio_codec), params.selected_audio_mode)
+
+        self.sinks[identity] = {
+            'm3': body.decode('ascii'),
+            'codec': codec,
+            'profile': params.selected_codec.profile,
+            'resolution': params.selected_resolution,
+            'encoder': params.selected_encoder,
+            'slices': params.selected_slices,
+            'audio': audio,
+            'encoders': self.fingerprint,
+        }
+        cache.store(self.NAME, self.sinks)
 
 
 class WFDClient(GstRtspServer.RTSPClient):
 
     __gtype_name__ = "WFDClient"
 
+    # Emitted when a step of the session completed: 'M1', 'M3', 'M4' and 'M5'
+    # (response received), 'SETUP' and 'PLAY' (request received) and
+    # 'TEARDOWN'. See control.py.
+    __gsignals__ = {
+        'wfd-step': (GObject.SignalFlags.RUN_LAST, None, (str,)),
+    }
+
     # REDIRECT and ANNOUNCE are not permissable
     SUPPORTED = [b'org.wfa.wfd1.0', b'OPTIONS', b'DESCRIBE', b'GET_PARAMETER', b'PAUSE', b'PLAY', b'SETUP', b'SET_PARAMETER', b'TEARDOWN']
 
-    # We set a shorter than default timeout. Note that we are not entirely
-    # standards compliant, because the keepalive message seems to happen only
-    # 2 seconds prior to expiry rather than 5 seconds.
+    # Session timeout (s), we send M16 keepalives KEEPALIVE_MARGIN seconds
+    # before it expires. A sink that does not answer within
+    # KEEPALIVE_RESPONSE_TIME is considered gone and the session is torn down.
     TIMEOUT = 30
+    KEEPALIVE_MARGIN = 5
+    KEEPALIVE_RESPONSE_TIME = 5
+    # Sinks that sent RTCP receiver reports and then stopped for this long (s)
+    # are considered gone as well, which is much faster than the keepalive.
+    RTCP_TIMEOUT = 10
+
+    # Send M4 right after M3 for known sinks, using the cached parameters
+    # while the M3 response is used to validate them.
+    SPECULATIVE_M4 = True
+    SINK_CACHE = None
 
     def __init__(self):
         super().__init__()
         self.init_state = InitState.M0_INVALID
         self.params = WFDParams()
+        self.wfd_media = None
+        # Codec, resolution (and slices) that was sent to the sink in a mode
+        # change M4 request
+        self.pending_codec = None
+        self.pending_resolution = None
+        self.pending_slices = 1
+        # (monotonic time, event) for each negotiation step
+        self.timings = []
+        self.identity = None
+        # Set while the M3 response is outstanding after a speculative M4
+        self.validating_m3 = False
+        self.pending_m4 = 0
+        # Set by the server, the number tells sinks behind one address apart
+        # in the metrics
+        self.number = 0
+        # Set by the server, used to prebuild the media during negotiation
+        self.factory = None
+        self.session = None
+        # Requests sent after the negotiation, responses arrive in order
+        self.expected_responses = []
+        self.keepalive_sent = None
+        self._last_keepalive = 0
+        self._liveness_timeout = None
+
+        self.connect('new-session', self._new_session)
+        self.connect('closed', self._closed)
+
+    def log_timing(self, what):
+        self.timings.append((time.monotonic(), what))
+
+    def timing_breakdown(self):
+        """Returns the negotiation steps in ms since the TCP connection was
+        accepted, together with the time since the previous step."""
+        if not self.timings:
+            return []
+
+        start = prev = self.timings[0][0]
+        breakdown = []
+        for t, what in self.timings:
+            breakdown.append((what, (t - start) * 1000, (t - prev) * 1000))
+            prev = t
+        return breakdown
+
+    def print_timings(self):
+        for what, total, delta in self.timing_breakdown():
+            print('%8.1f ms (+%6.1f ms)  %s' % (total, delta, what))
+
+    def metrics(self):
+        """Returns the negotiation timings and the statistics of the media"""
+        # Steps can repeat (e.g. the corrected M4 after a speculative one),
+        # only the last time is exported
+        steps = {what: total for what, total, delta in self.timing_breakdown()}
+        result = [metrics.gauge('wfd_negotiation_step_ms', 'Time of the negotiation step since the TCP connection (ms)',
+                                total, step=what)
+                  for what, total in steps.items()]
+        result.append(metrics.gauge('wfd_negotiated', 'Whether the M1-M5 negotiation is complete',
+                                    int(self.init_state == InitState.DONE)))
+        if self.wfd_media is not None:
+            result += self.wfd_media.metrics()
+        return result
 
     def get_presentation_url(self):
         socket = self.get_connection().get_read_socket()
@@ -488,11 +369,56 @@ class WFDClient(GstRtspServer.RTSPClient):
 
         return "rtsp://%s:%d/wfd1.0/streamid=0" % (addr, port)
 
-#    def do_new_session(self, session):
-#        session.set_timeout(self.TIMEOUT)
+    def _new_session(self, client, session):
+        session.set_timeout(self.TIMEOUT)
+        self.session = session
+        self._last_keepalive = time.monotonic()
+        if self._liveness_timeout is None:
+            self._liveness_timeout = GLib.timeout_add_seconds(1, self._check_liveness)
+
+    def _closed(self, client):
+        if self._liveness_timeout is not None:
+            GLib.source_remove(self._liveness_timeout)
+            self._liveness_timeout = None
+        if self.factory is not None:
+            self.factory.release(self)
+
+    def _check_liveness(self):
+        now = time.monotonic()
+        if self.keepalive_sent is not None:
+            if now - self.keepalive_sent > self.KEEPALIVE_RESPONSE_TIME:
+                return self._sink_gone('no response to keepalive')
+        elif now - self._last_keepalive >= self.TIMEOUT - self.KEEPALIVE_MARGIN:
+            self.wfd_keepalive()
+
+        # With a shared media the reports cannot be attributed to one sink
+        media = self.wfd_media
+        if media is not None and not media.is_shared() and media.last_rtcp is not None:
+            if now - media.last_rtcp > self.RTCP_TIMEOUT:
+                return self._sink_gone('no RTCP for %.0f s' % (now - media.last_rtcp))
+
+        return True
+
+    def _sink_gone(self, reason):
+        print('WARNING: Sink is gone (%s), tearing down the session' % reason)
+        self._liveness_timeout = None
+        # Removing the session unprepares the media right away, instead of
+        # waiting for the session to time out.
+        if self.session is not None:
+            self.get_session_pool().remove(self.session)
+            self.session = None
+        self.close()
+        return False
+
+    def wfd_keepalive(self):
+        """Send an M16 keepalive, the response refreshes the session"""
+        msg = GstRtsp.rtsp_message_new()[1] # GstRtsp.RTSPMessage()
+        msg.init_request(GstRtsp.RTSPMethod.GET_PARAMETER, 'rtsp://localhost/wfd1.0')
+        self.send_message(session=self.session, message=msg)
+        self.expected_responses.append('keepalive')
+        self.keepalive_sent = self._last_keepalive = time.monotonic()
 
     def do_send_message(self, ctx, message):
-        print("sending message")
         # Manipulate any "Public" header to send protocol support for WFD
         res, value = message.get_header(GstRtsp.RTSPHeaderField.PUBLIC, 0)
         if value is not None:
@@ -503,13 +429,13 @@ class WFDClient(GstRtspServer.RTSPClient):
     def do_pre_options_request(self, ctx):
         # Check whether we are in the setup phase, if yes, we need to schedule
         # triggering the next step by setting up parameters
-        print('Got options request, current init state: ', self.init_state, InitState.M2_SINK_QUERY_OPTIONS.value)
         if self.init_state.value <= InitState.M2_SINK_QUERY_OPTIONS.value:
             if self.init_state == InitState.M1_SOURCE_QUERY_OPTIONS:
                 print('WARNING: Got OPTIONS before getting reply querying for WFD support, continuing anyway')
-            # Continue to query the parameters
-            print('idle adding wfd_query_params')
-            GLib.idle_add(self.wfd_query_params)
+            self.log_timing('M2 request received')
+            # Continue to query the parameters, this needs to happen after
+            # the OPTIONS response has been sent.
+            GLib.idle_add(self.wfd_query_params, priority=GLib.PRIORITY_HIGH)
 
         # NOTE: We cannot modify ctx.response here, so modification happens in
         #       do_send_message!
@@ -522,36 +448,129 @@ class WFDClient(GstRtspServer.RTSPClient):
         msg.init_request(GstRtsp.RTSPMethod.OPTIONS, '*')
         msg.add_header_by_name('Require', 'org.wfa.wfd1.0')
         self.send_message(session=None, message=msg)
+        self.log_timing('M1 sent')
 
     def wfd_query_params(self):
-        print('hello from wfd query params')
-        self.init_state = InitState.M3_SOURCE_GET_PARAMS
         msg = GstRtsp.rtsp_message_new()[1] # GstRtsp.RTSPMessage()
         msg.init_request(GstRtsp.RTSPMethod.GET_PARAMETER, 'rtsp://localhost/wfd1.0')
         msg.set_body(self.params.m3_query_params())
         msg.add_header_by_name('Content-Type', 'text/parameters')
+
+        # The state for the response has to be set up before M3 is sent
+        self.init_state = InitState.M3_SOURCE_GET_PARAMS
+        if self.SPECULATIVE_M4 and self.SINK_CACHE is not None:
+            self.identity = SinkCache.identity(self.get_connection().get_ip())
+            params = self.SINK_CACHE.lookup(self.identity)
+            if params is not None:
+                print('INFO: Known sink %s, sending M4 with cached parameters' % self.identity)
+                self.params = params
+                self.validating_m3 = True
+                self.init_state = InitState.M4_SOURCE_SET_PARAMS
+
         self.send_message(session=None, message=msg)
+        self.log_timing('M3 sent')
+
+        if self.validating_m3:
+            self.wfd_set_params()
+
+    def _validate_m3(self, body):
+        self.validating_m3 = False
+        if self.SINK_CACHE.matches(self.identity, body):
+            self.log_timing('M3 response received, cache valid')
+            self.emit('wfd-step', 'M3')
+            return
+
+        # The sink changed, start over with the real parameters and correct
+        # the speculative M4.
+        print('WARNING: Cached parameters of sink %s are outdated' % self.identity)
+        self.log_timing('M3 response received, cache outdated')
+        self.params = WFDParams()
+        self.params.from_sink(body)
+        WFDMedia.wfd_select_codecs(self.params)
+        self.SINK_CACHE.store(self.identity, body, self.params)
+        self.emit('wfd-step', 'M3')
+        self.wfd_set_params()
+
+    def _prewarm(self):
+        # SETUP may have been faster
+        if self.factory is not None and self.wfd_media is None:
+            self.factory.prewarm(self.params, self)
+        return False
 
     def wfd_set_params(self):
         self.init_state = InitState.M4_SOURCE_SET_PARAMS
+        self.pending_m4 += 1
         msg = GstRtsp.rtsp_message_new()[1] # GstRtsp.RTSPMessage()
         msg.init_request(GstRtsp.RTSPMethod.SET_PARAMETER, 'rtsp://localhost/wfd1.0')
 
         params = []
-        params.append('wfd_video_formats: %s' % self.params.selected_codec.descr_for_resolution(self.params.selected_resolution))
-        params.append('wfd_audio_codecs: none')
+        codec = self.params.selected_codec
+        params.append('wfd_video_formats: %s' % codec.descr_for_resolution(self.params.selected_resolution, self.params.selected_slices))
+        if self.params.selected_audio_codec is not None:
+            params.append('wfd_audio_codecs: %s' % self.params.selected_audio_codec.descr_for_mode(self.params.selected_audio_mode))
+        else:
+            params.append('wfd_audio_codecs: none')
         params.append('wfd_presentation_URL: %s none' % self.get_presentation_url())
-        params.append('wfd_client_rtp_ports: RTP/AVP/UDP;unicast %u %u mode=play' % (self.params.primary_rtp_port, self.params.secondary_rtp_port))
+        params.append('wfd_client_rtp_ports: %s %u %u mode=play' % (self.params.profile, self.params.primary_rtp_port, self.params.secondary_rtp_port))
 
         params = '\r\n'.join(params) + '\r\n'
 
         msg.set_body(bytes(params, 'ascii'))
         msg.add_header_by_name('Content-Type', 'text/parameters')
         self.send_message(session=None, message=msg)
+        self.log_timing('M4 sent')
+
+        # Build the pipeline while waiting for the M4 response and SETUP
+        GLib.idle_add(self._prewarm)
+
+    def wfd_change_mode(self, width, height, framerate=None, interlaced=None, profile=None):
+        """Renegotiate the video mode of a running session. Sends an M4 request
+        with the new mode and switches the pipeline once the sink accepted
+        it, without tearing down the session.
+
+        profile ('CBP' or 'CHP') switches to another H.264 codec of the sink,
+        None keeps the current one. The encoder stays the same."""
+        if self.init_state != InitState.DONE or self.wfd_media is None:
+            print('ERROR: Cannot change mode before the session is set up')
+            return False
+
+        codec = self.params.selected_codec
+        if profile is not None and profile != codec.profile:
+            if profile == 'CHP' and self.params.selected_encoder == 'openh264':
+                print('ERROR: openh264 only supports the base profile')
+                return False
+            codec = next((c for c in self.params.video_codecs if c.profile == profile), None)
+            if codec is None:
+                print('ERROR: Sink does not support the %s profile' % profile)
+                return False
+
+        resolution = codec.find_resolution(width, height, framerate, interlaced)
+        if resolution is None:
+            print('ERROR: Sink does not support %dx%d in the %s profile' % (width, height, codec.profile))
+            return False
+
+        self.pending_codec = codec
+        self.pending_resolution = resolution
+        self.expected_responses.append('mode')
+        self.pending_slices = codec.slices_for(resolution, WFDMedia.SLICES)
+        msg = GstRtsp.rtsp_message_new()[1] # GstRtsp.RTSPMessage()
+        msg.init_request(GstRtsp.RTSPMethod.SET_PARAMETER, 'rtsp://localhost/wfd1.0')
+
+        params = []
+        params.append('wfd_video_formats: %s' % codec.descr_for_resolution(resolution, self.pending_slices))
+
+        params = '\r\n'.join(params) + '\r\n'
+
+        msg.set_body(bytes(params, 'ascii'))
+        msg.add_header_by_name('Content-Type', 'text/parameters')
+        self.send_message(session=None, message=msg)
+        return True
 
     def wfd_trigger_method(self, method):
         if method == 'SETUP' and self.init_state == InitState.M4_SOURCE_SET_PARAMS:
             self.init_state = InitState.M5_SOURCE_TRIGGER_SETUP
+        elif self.init_state == InitState.DONE:
+            self.expected_responses.append('trigger')
 
         msg = GstRtsp.rtsp_message_new()[1] # GstRtsp.RTSPMessage()
         msg.init_request(GstRtsp.RTSPMethod.SET_PARAMETER, 'rtsp://localhost/wfd1.0')
@@ -563,36 +582,108 @@ class WFDClient(GstRtspServer.RTSPClient):
         msg.set_body(bytes(params, 'ascii'))
         msg.add_header_by_name('Content-Type', 'text/parameters')
         self.send_message(session=None, message=msg)
+        self.log_timing('M5 sent (%s)' % method)
 
     def do_configure_client_media(self, media, stream, ctx):
         print('Configuring media')
         # Store media object for other actions
         self.wfd_media = media
         media.wfd_configure(self.params)
+        media.connect_first_packet(self._first_packet)
 
         if not GstRtspServer.RTSPClient.do_configure_client_media(self, media, stream, ctx):
             return False
 
         return True
 
-    def do_handle_message(self, message):
-        print('Got message', message)
+    def do_configure_client_transport(self, ctx, ct):
+        if not GstRtspServer.RTSPClient.do_configure_client_transport(self, ctx, ct):
+            return False
+
+        # RTP is interleaved into the RTSP connection
+        if ct.lower_transport == GstRtsp.RTSPLowerTrans.TCP and self.wfd_media is not None:
+            self.wfd_media.set_tcp_socket(self.get_connection().get_write_socket())
+
+        return True
+
+    def _first_packet(self):
+        self.log_timing('first RTP packet')
+        GLib.idle_add(self.print_timings)
+
+    def do_pre_setup_request(self, ctx):
+        self.log_timing('M6 SETUP received')
+        self.emit('wfd-step', 'SETUP')
+        return GstRtsp.RTSPStatusCode.OK
+
+    def do_pre_play_request(self, ctx):
+        self.log_timing('M7 PLAY received')
+        self.emit('wfd-step', 'PLAY')
+        return GstRtsp.RTSPStatusCode.OK
+
+    def do_pre_teardown_request(self, ctx):
+        self.emit('wfd-step', 'TEARDOWN')
+        return GstRtsp.RTSPStatusCode.OK
 
     def do_handle_response(self, ctx):
         if self.init_state == InitState.M1_SOURCE_QUERY_OPTIONS:
+            self.log_timing('M1 response received')
             # XXX: The standard says to disconnect, but this allows testing with e.g. VLC
             self.init_state = InitState.M2_SINK_QUERY_OPTIONS
+            self.emit('wfd-step', 'M1')
 
         elif self.init_state == InitState.M3_SOURCE_GET_PARAMS:
-            self.params.from_sink(ctx.response.get_body()[1])
+            self.log_timing('M3 response received')
+            body = ctx.response.get_body()[1]
+            self.params.from_sink(body)
             WFDMedia.wfd_select_codecs(self.params)
-            GLib.idle_add(self.wfd_set_params)
+            self.log_timing('M3 parsed, mode selected')
+            if self.SINK_CACHE is not None:
+                self.identity = SinkCache.identity(self.get_connection().get_ip())
+                self.SINK_CACHE.store(self.identity, body, self.params)
+            self.emit('wfd-step', 'M3')
+            self.wfd_set_params()
 
         elif self.init_state == InitState.M4_SOURCE_SET_PARAMS:
-            GLib.idle_add(lambda : self.wfd_trigger_method('SETUP'))
+            if self.validating_m3:
+                # Responses arrive in order, so this answers the M3 request
+                self._validate_m3(ctx.response.get_body()[1])
+                return
+
+            self.log_timing('M4 response received')
+            self.pending_m4 -= 1
+            if self.pending_m4 == 0:
+                self.emit('wfd-step', 'M4')
+                self.wfd_trigger_method('SETUP')
 
         elif self.init_state == InitState.M5_SOURCE_TRIGGER_SETUP:
+            self.log_timing('M5 response received')
             self.init_state = InitState.DONE
+            self.emit('wfd-step', 'M5')
+
+        elif self.expected_responses:
+            what = self.expected_responses.pop(0)
+            if what == 'keepalive':
+                self.keepalive_sent = None
+                if self.session is not None:
+                    self.session.touch()
+                return
+            elif what != 'mode':
+                return
+
+            codec = self.pending_codec
+            resolution = self.pending_resolution
+            self.pending_codec = None
+            self.pending_resolution = None
+
+            res, code, version, reason = ctx.response.parse_response()
+            if code != GstRtsp.RTSPStatusCode.OK:
+                print('ERROR: Sink rejected mode change to %dx%d %s (%s)' % (resolution[0], resolution[1], codec.profile, reason))
+                return
+
+            self.params.selected_codec = codec
+            self.params.selected_resolution = resolution
+            self.params.selected_slices = self.pending_slices
+            self.wfd_media.wfd_reconfigure(self.params)
 
     def do_check_requirements(self, ctx, requires):
         print('Checking client requires: %s' % ', '.join(requires))
@@ -641,58 +732,30 @@ class WFDClient(GstRtspServer.RTSPClient):
 
         status, body = ctx.request.get_body()
         body = body.strip(b'\x00')
-        print(body)
         # This should never happen, as it will already be filtered in that case
         if not body:
             return GstRtsp.RTSPResult.OK
 
-        params = {}
-
-        # Params are separated by CRLF, just split on LF and strip
-        for option in body.split(b'\n'):
-            option = option.decode('ascii')
-            option = option.strip()
-            print(option)
-            # Ignore empty lines
-            if not option:
-                continue
-            option = option.split(':', 1)
-            if len(option) != 2:
-                val = None
-            else:
-                val = option[1].strip()
-            param = option[0]
-            params[param] = val
+        params = WFDParams.parse_body(body)
 
-        print(params)
         # Just set the body to confirm all options
         response.set_body(('\r\n'.join(params.keys())+'\r\n').encode('ascii'))
 
+        # Capabilities (e.g. wfd_connector_type) are parsed like in M3
+        self.params.update(params)
 
         for param, val in params.items():
             if param == 'wfd_trigger_method':
                 print('ERROR: The WFD sink may not trigger any methods!')
             elif param == 'wfd_route':
                 print('ERROR: The WFD sink cannot set whether to route audio the primary/secondary sink')
-            elif param == 'wfd_connector_type':
-                if value != 'none':
-                    try:
-                        connector = int(value, 16)
-                    except ValueError:
-                        print('ERROR: Could not parse connector %s' % value)
-                    if not connector in CONNECTOR_TYPE:
-                        print('ERROR: Connector %02X reported by sink is not known' % connector)
-                    else:
-                        print('INFO: Sink is reporting connector of type %s' % CONNECTOR_TYPE[connector])
             elif param == 'wfd_uibc_setting':
                 pass
             elif param == 'wfd_standby':
                 pass
             elif param == 'wfd_idr_request':
-                print('GOT IDR REQUEST!')
-                self.wfd_media.force_keyframe()
-            elif param == 'wfd_uibc_capability':
-                pass
+                if self.wfd_media is not None:
+                    self.wfd_media.force_keyframe()
 
         return GstRtsp.RTSPResult.OK
 
@@ -700,33 +763,48 @@ class WFDServer(GstRtspServer.RTSPServer):
 
     __gtype_name__ = "WFDServer"
 
-    def __init__(self):
+    def __init__(self, port=7236):
         super().__init__()
-        factory = WFDMediaFactory()
+        self.factory = WFDMediaFactory()
         mount_points = self.get_mount_points()
-        mount_points.add_factory("/wfd1.0", factory)
+        mount_points.add_factory("/wfd1.0", self.factory)
 
-        # TODO: Allow using another port!
         self.set_address("0.0.0.0")
-        self.set_service("7236")
+        self.set_service(str(port))
         self.ifname = None
+        self.clients = []
+        self._clients_created = 0
 
         self.connect("client-connected", self.client_connected_cb)
 
         GLib.timeout_add_seconds(2, self._clean_pool)
 
     def _clean_pool(self):
+        # Removes sessions that timed out (and unprepares their media)
         session_pool = self.get_session_pool()
         session_pool.cleanup()
+        return True
 
     def client_connected_cb(self, server, client):
         # XXX: Reject clients here that are unexpected?
 
+        client.log_timing('TCP connection accepted')
+        self.clients.append(client)
+        client.connect('closed', lambda client: self.clients.remove(client))
+
         # WFD is a bit special and the server should query parameters right
         # away. Trigger this here.
-        # Delay the whole thing a bit as the client is not attached at this
-        # point.
-        GLib.timeout_add(500, lambda : client.wfd_query_support())
+        # The client is not attached at this point, but it is before control
+        # returns to the mainloop.
+        GLib.idle_add(client.wfd_query_support, priority=GLib.PRIORITY_HIGH)
+
+    def collect_metrics(self):
+        result = []
+        for client in self.clients:
+            conn = client.get_connection()
+            result.append(({'sink': conn.get_ip() if conn is not None else 'unknown',
+                            'client': client.number}, client.metrics()))
+        return result
 
     def set_interface(self, ifname):
         self.ifname = ifname
@@ -762,6 +840,9 @@ class WFDServer(GstRtspServer.RTSPServer):
         client.set_mount_points (self.get_mount_points())
         client.set_auth (self.get_auth())
         client.set_thread_pool (self.get_thread_pool())
+        client.factory = self.factory
+        self._clients_created += 1
+        client.number = self._clients_created
         return client
 
 if __name__ == '__main__':
@@ -770,16 +851,47 @@ if __name__ == '__main__':
     DBusGMainLoop(set_as_default=True)
 
     import sys
+    import dbus
 
     import wfd
     source_ies = wfd.WFDSourceIEs()
     source_ies.port = 7236
+    WFDMedia.LINK_THROUGHPUT = source_ies.throughput
+
+    # MIRACAST_PROFILE=1 prints per-element latency and CPU time at the end
+    # of every session, the tracer log and pipeline graph go to the cache
+    # directory.
+    import os
+    if os.environ.get('MIRACAST_PROFILE'):
+        import profiling
+        os.makedirs(cache.cache_path(''), exist_ok=True)
+        os.environ.setdefault('GST_DEBUG_DUMP_DOT_DIR', cache.cache_path(''))
+        profiling.enable_tracers(cache.cache_path('tracer.log'))
+        WFDMedia.PROFILING = True
+        WFDMedia.DUMP_DOT = True
 
     Gst.init(sys.argv)
 
+    WFDClient.SINK_CACHE = SinkCache()
+
+    # Measures the encoders on the first start, then loads the cached results
+    encoders.CAPABILITIES = encoders.EncoderCapabilities.load_or_probe(WFDMedia.PROFILE)
+
+    # Ask for screen cast permission early, the capture source falls back to
+    # X11 or a test image until the portal is ready.
+    import capture
+    try:
+        capture.PipeWireCaptureSource.PORTAL = capture.ScreenCastPortal()
+        capture.PipeWireCaptureSource.PORTAL.start()
+    except dbus.exceptions.DBusException as e:
+        print('WARNING: Screen cast portal not available: %s' % e)
+
     server = WFDServer()
     server.attach()
 
+    metrics_server = metrics.MetricsServer(server)
+    metrics_server.start()
+
     supplicant = wfd.WpaSupplicant()
     import atexit
     atexit.register(lambda *args: supplicant.set_wfd_sub_elems(None))
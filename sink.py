@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+
+import gi
+
+gi.require_version('Gst', '1.0')
+
+import socket
+import time
+
+from gi.repository import GLib
+from gi.repository import Gst
+
+
+class RTSPMessage:
+    def __init__(self, start_line, headers=None, body=b''):
+        self.start_line = start_line
+        self.headers = headers or {}
+        self.body = body
+
+    @property
+    def is_response(self):
+        return self.start_line.startswith('RTSP/')
+
+    @property
+    def method(self):
+        return self.start_line.split()[0]
+
+    @property
+    def status(self):
+        return int(self.start_line.split()[1])
+
+    def get(self, header, default=None):
+        return self.headers.get(header.lower(), default)
+
+    def to_bytes(self):
+        lines = [self.start_line]
+        for header, value in self.headers.items():
+            lines.append('%s: %s' % (header, value))
+        if self.body:
+            lines.append('Content-Length: %d' % len(self.body))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('ascii') + self.body
+
+    @classmethod
+    def parse(cls, data):
+        """Parse one message from the start of data. Returns the message and
+        the remaining data, or None and data if the message is incomplete."""
+        end = data.find(b'\r\n\r\n')
+        if end < 0:
+            return None, data
+
+        lines = data[:end].decode('ascii').split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            header, value = line.split(':', 1)
+            headers[header.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length', 0))
+        if len(data) < end + 4 + length:
+            return None, data
+
+        body = data[end + 4:end + 4 + length]
+        return cls(lines[0], headers, body), data[end + 4 + length:]
+
+
+class WFDSink:
+    """A headless WFD sink for integration and performance testing.
+
+    Answers the M1-M5 requests of a source with the configured capabilities,
+    sets up the stream (M6/M7), then receives, depacketizes and decodes it.
+    report() returns the negotiation timings and stream statistics.
+
+    Supported quirks:
+     * 'no-m2': never send the M2 OPTIONS request
+     * 'reject-m4': answer M4 with 400 Bad Request
+     * 'no-rtcp': do not send RTCP receiver reports
+     * 'no-m16': do not answer M16 keepalives (like a sink that is gone)"""
+
+    # A 1080p30 CHP and CBP capable sink
+    VIDEO_FORMATS = '38 00 02 10 0001FFFF 1FFFFFFF 00000FFF 00 0000 0000 11 none none, 01 10 0001FFFF 1FFFFFFF 00000FFF 00 0000 0000 11 none none'
+    AUDIO_CODECS = 'LPCM 00000003 00, AAC 00000001 00'
+
+    def __init__(self, video_formats=VIDEO_FORMATS, audio_codecs=AUDIO_CODECS,
+                 edid=None, rtp_port=16384, quirks=(), response_delay=0, fec_pt=None):
+        self.video_formats = video_formats
+        self.audio_codecs = audio_codecs
+        self.edid = edid
+        self.rtp_port = rtp_port
+        self.quirks = set(quirks)
+        # Artificial delay (ms) before answering requests of the source
+        self.response_delay = response_delay
+        # Payload type of ULPFEC packets to decode, None to ignore FEC
+        self.fec_pt = fec_pt
+        self.fec_decoder = None
+
+        self.sock = None
+        self._data = b''
+        self._cseq = 0
+        self._pending = {}
+        self.session = None
+        self.presentation_url = None
+        self.server_rtcp_port = None
+        self.pipeline = None
+
+        self.start_time = None
+        # (monotonic time, description) for every RTSP message
+        self.timings = []
+        self.first_rtp = None
+        self.first_frame = None
+        self.last_frame = None
+        self.frames = 0
+        self.decode_errors = 0
+        self.jitterbuffer = None
+        self.idr_requests = 0
+
+    def _log(self, what):
+        self.timings.append((time.monotonic(), what))
+
+    def connect(self, host='127.0.0.1', port=7236):
+        self.start_time = time.monotonic()
+        self.host = host
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._log('connected')
+        GLib.io_add_watch(self.sock.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IOCondition.IN | GLib.IOCondition.HUP, self._readable)
+
+    def close(self):
+        if self.pipeline is not None:
+            self.pipeline.set_state(Gst.State.NULL)
+            self.pipeline = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _readable(self, fd, condition):
+        data = self.sock.recv(65536) if self.sock else b''
+        if not data:
+            self._log('disconnected')
+            self.close()
+            return False
+
+        self._data += data
+        while True:
+            msg, self._data = RTSPMessage.parse(self._data)
+            if msg is None:
+                break
+            if msg.is_response:
+                self._handle_response(msg)
+            elif self.response_delay:
+                GLib.timeout_add(self.response_delay, self._handle_request, msg)
+            else:
+                self._handle_request(msg)
+
+        return True
+
+    def _send(self, msg):
+        self.sock.sendall(msg.to_bytes())
+
+    def send_request(self, method, url, headers=None, body=b'', callback=None):
+        self._cseq += 1
+        headers = dict(headers or {})
+        headers['CSeq'] = str(self._cseq)
+        if self.session is not None:
+            headers['Session'] = self.session
+        if body:
+            headers['Content-Type'] = 'text/parameters'
+
+        self._pending[self._cseq] = (method, callback)
+        self._log('sent %s' % method)
+        self._send(RTSPMessage('%s %s RTSP/1.0' % (method, url), headers, body))
+
+    def _reply(self, request, status=200, reason='OK', headers=None, body=b''):
+        headers = dict(headers or {})
+        headers['CSeq'] = request.get('CSeq')
+        self._send(RTSPMessage('RTSP/1.0 %d %s' % (status, reason), headers, body))
+
+    @staticmethod
+    def _parse_params(body):
+        params = {}
+        for line in body.decode('ascii').split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+            param, _, val = line.partition(':')
+            params[param.strip()] = val.strip()
+        return params
+
+    def _param_value(self, param):
+        if param == 'wfd_video_formats':
+            return self.video_formats
+        elif param == 'wfd_audio_codecs':
+            return self.audio_codecs
+        elif param == 'wfd_client_rtp_ports':
+            return 'RTP/AVP/UDP;unicast %d 0 mode=play' % self.rtp_port
+        elif param == 'wfd_display_edid':
+            if self.edid is None:
+                return 'none'
+            return '%04X %s' % (len(self.edid) // 128, self.edid.hex().upper())
+        return 'none'
+
+    def _handle_request(self, msg):
+        method = msg.method
+        if method == 'OPTIONS':
+            self._log('M1 received')
+            self._reply(msg, headers={'Public': 'org.wfa.wfd1.0, GET_PARAMETER, SET_PARAMETER'})
+            if 'no-m2' not in self.quirks:
+                self.send_request('OPTIONS', '*', {'Require': 'org.wfa.wfd1.0'})
+
+        elif method == 'GET_PARAMETER':
+            if not msg.body.strip():
+                # M16 keepalive
+                self._log('M16 received')
+                if 'no-m16' not in self.quirks:
+                    self._reply(msg)
+                return False
+
+            self._log('M3 received')
+            params = [p.strip() for p in msg.body.decode('ascii').split('\n') if p.strip()]
+            body = ''.join('%s: %s\r\n' % (p, self._param_value(p)) for p in params)
+            self._reply(msg, headers={'Content-Type': 'text/parameters'}, body=body.encode('ascii'))
+
+        elif method == 'SET_PARAMETER':
+            params = self._parse_params(msg.body)
+            trigger = params.get('wfd_trigger_method')
+            if trigger is None:
+                self._log('M4 received')
+                if 'reject-m4' in self.quirks:
+                    self._reply(msg, 400, 'Bad Request')
+                    return False
+                if 'wfd_presentation_URL' in params:
+                    self.presentation_url = params['wfd_presentation_URL'].split()[0]
+                self.negotiated = params
+                self._reply(msg)
+            else:
+                self._log('M5 received (%s)' % trigger)
+                self._reply(msg)
+                if trigger == 'SETUP':
+                    self.setup()
+                elif trigger == 'TEARDOWN':
+                    self.teardown()
+
+        else:
+            self._reply(msg, 501, 'Not Implemented')
+
+        return False
+
+    def _handle_response(self, msg):
+        method, callback = self._pending.pop(int(msg.get('CSeq', -1)), (None, None))
+        self._log('response %s %d' % (method, msg.status))
+        if callback is not None:
+            callback(msg)
+
+    def setup(self):
+        self._start_pipeline()
+        transport = 'RTP/AVP/UDP;unicast;client_port=%d-%d' % (self.rtp_port, self.rtp_port + 1)
+        self.send_request('SETUP', self.presentation_url, {'Transport': transport},
+                          callback=self._setup_done)
+
+    def _setup_done(self, msg):
+        if msg.status != 200:
+            print('ERROR: SETUP failed with %d' % msg.status)
+            return
+
+        self.session = msg.get('Session').split(';')[0]
+        for part in msg.get('Transport', '').split(';'):
+            if part.startswith('server_port='):
+                self.server_rtcp_port = int(part.split('=')[1].split('-')[1])
+        self._start_rtcp()
+
+        self.send_request('PLAY', self.presentation_url)
+
+    def teardown(self):
+        self.send_request('TEARDOWN', self.presentation_url)
+
+    def request_idr(self):
+        self.idr_requests += 1
+        self.send_request('SET_PARAMETER', 'rtsp://localhost/wfd1.0',
+                          body=b'wfd_idr_request\r\n')
+
+    def _start_pipeline(self):
+        self.pipeline = Gst.Pipeline(name='wfdsink')
+        self.rtpbin = Gst.ElementFactory.make('rtpbin')
+        self.rtpbin.connect('new-jitterbuffer', self._new_jitterbuffer)
+        self.rtpbin.connect('pad-added', self._rtpbin_pad_added)
+        if self.fec_pt is not None:
+            self.rtpbin.connect('request-fec-decoder', self._request_fec_decoder)
+        self.pipeline.add(self.rtpbin)
+
+        rtpsrc = Gst.ElementFactory.make('udpsrc')
+        rtpsrc.props.port = self.rtp_port
+        rtpsrc.props.caps = Gst.Caps.from_string(
+            'application/x-rtp,media=video,clock-rate=90000,encoding-name=MP2T,payload=33')
+        self.pipeline.add(rtpsrc)
+        assert rtpsrc.link_pads('src', self.rtpbin, 'recv_rtp_sink_0')
+        rtpsrc.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self._rtp_received)
+
+        self.rtcpsrc = Gst.ElementFactory.make('udpsrc')
+        self.rtcpsrc.props.port = self.rtp_port + 1
+        self.pipeline.add(self.rtcpsrc)
+        assert self.rtcpsrc.link_pads('src', self.rtpbin, 'recv_rtcp_sink_0')
+
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message', self._bus_message)
+
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def _start_rtcp(self):
+        if 'no-rtcp' in self.quirks or self.server_rtcp_port is None:
+            return
+
+        rtcpsink = Gst.ElementFactory.make('udpsink')
+        rtcpsink.props.host = self.host
+        rtcpsink.props.port = self.server_rtcp_port
+        rtcpsink.props.sync = False
+        rtcpsink.props.async_ = False
+        # Send from our RTCP port, the source expects this
+        rtcpsink.props.socket = self.rtcpsrc.props.used_socket
+        self.pipeline.add(rtcpsink)
+        assert self.rtpbin.link_pads('send_rtcp_src_0', rtcpsink, 'sink')
+        rtcpsink.sync_state_with_parent()
+
+    def _request_fec_decoder(self, rtpbin, session):
+        # Media packets are kept in the storage to recover lost ones from
+        storage = rtpbin.emit('get-storage', session)
+        storage.props.size_time = 250 * Gst.MSECOND
+        self.fec_decoder = Gst.ElementFactory.make('rtpulpfecdec')
+        self.fec_decoder.props.pt = self.fec_pt
+        self.fec_decoder.props.storage = rtpbin.emit('get-internal-storage', session)
+        return self.fec_decoder
+
+    def _new_jitterbuffer(self, rtpbin, jitterbuffer, session, ssrc):
+        self.jitterbuffer = jitterbuffer
+
+    def _rtpbin_pad_added(self, rtpbin, pad):
+        if not pad.get_name().startswith('recv_rtp_src_'):
+            return
+
+        depay = Gst.ElementFactory.make('rtpmp2tdepay')
+        demux = Gst.ElementFactory.make('tsdemux')
+        demux.connect('pad-added', self._demux_pad_added)
+        for element in (depay, demux):
+            self.pipeline.add(element)
+        assert pad.link(depay.get_static_pad('sink')) == Gst.PadLinkReturn.OK
+        assert depay.link(demux)
+        depay.sync_state_with_parent()
+        demux.sync_state_with_parent()
+
+    def _demux_pad_added(self, demux, pad):
+        sink = Gst.ElementFactory.make('fakesink')
+        sink.props.sync = False
+
+        if pad.get_name().startswith('video'):
+            parse = Gst.ElementFactory.make('h264parse')
+            decoder = Gst.ElementFactory.make('avdec_h264')
+            elements = [parse, decoder, sink]
+            decoder.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self._frame_decoded)
+        else:
+            elements = [sink]
+
+        prev = None
+        for element in elements:
+            self.pipeline.add(element)
+            if prev is not None:
+                assert prev.link(element)
+            prev = element
+        assert pad.link(elements[0].get_static_pad('sink')) == Gst.PadLinkReturn.OK
+        for element in elements:
+            element.sync_state_with_parent()
+
+    def _rtp_received(self, pad, info):
+        if self.first_rtp is None:
+            self.first_rtp = time.monotonic()
+        return Gst.PadProbeReturn.OK
+
+    def _frame_decoded(self, pad, info):
+        now = time.monotonic()
+        if self.first_frame is None:
+            self.first_frame = now
+        self.last_frame = now
+        self.frames += 1
+        if info.get_buffer().has_flags(Gst.BufferFlags.CORRUPTED):
+            self.decode_errors += 1
+        return Gst.PadProbeReturn.OK
+
+    def _bus_message(self, bus, msg):
+        if msg.type in (Gst.MessageType.ERROR, Gst.MessageType.WARNING):
+            # Decoder warnings are about broken frames
+            self.decode_errors += 1
+            err, debug = msg.parse_error() if msg.type == Gst.MessageType.ERROR else msg.parse_warning()
+            print('WARNING: %s: %s' % (msg.src.get_name(), err.message))
+
+    def report(self):
+        report = {
+            'timings': [(t - self.start_time, what) for t, what in self.timings],
+            'first-rtp': None,
+            'first-frame': None,
+            'fps': 0.0,
+            'frames': self.frames,
+            'lost': 0,
+            'fec-recovered': 0,
+            'decode-errors': self.decode_errors,
+        }
+        if self.first_rtp is not None:
+            report['first-rtp'] = self.first_rtp - self.start_time
+        if self.first_frame is not None:
+            report['first-frame'] = self.first_frame - self.start_time
+            if self.frames > 1 and self.last_frame > self.first_frame:
+                report['fps'] = (self.frames - 1) / (self.last_frame - self.first_frame)
+        if self.jitterbuffer is not None:
+            report['lost'] = self.jitterbuffer.props.stats.get_value('num-lost')
+        if self.fec_decoder is not None:
+            report['fec-recovered'] = self.fec_decoder.props.recovered
+
+        return report
+
+
+def print_report(report):
+    for t, what in report['timings']:
+        print('%8.1f ms  %s' % (t * 1000, what))
+    for key in ('first-rtp', 'first-frame'):
+        if report[key] is not None:
+            print('%s: %.1f ms' % (key, report[key] * 1000))
+        else:
+            print('%s: never' % key)
+    print('frames: %d, fps: %.1f, lost packets: %d, recovered by FEC: %d, decode errors: %d' % (
+        report['frames'], report['fps'], report['lost'], report['fec-recovered'], report['decode-errors']))
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Headless WFD sink for testing')
+    parser.add_argument('host', nargs='?', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7236)
+    parser.add_argument('--rtp-port', type=int, default=16384)
+    parser.add_argument('--video-formats', default=WFDSink.VIDEO_FORMATS)
+    parser.add_argument('--audio-codecs', default=WFDSink.AUDIO_CODECS)
+    parser.add_argument('--edid', help='EDID as hex string')
+    parser.add_argument('--quirk', action='append', default=[])
+    parser.add_argument('--response-delay', type=int, default=0, help='ms')
+    parser.add_argument('--duration', type=int, default=10, help='seconds to stream')
+    parser.add_argument('--fec-pt', type=int, help='payload type of ULPFEC packets to decode')
+    args = parser.parse_args()
+
+    Gst.init(sys.argv)
+
+    sink = WFDSink(video_formats=args.video_formats,
+                   audio_codecs=args.audio_codecs,
+                   edid=bytes.fromhex(args.edid) if args.edid else None,
+                   rtp_port=args.rtp_port,
+                   quirks=args.quirk,
+                   response_delay=args.response_delay,
+                   fec_pt=args.fec_pt)
+    sink.connect(args.host, args.port)
+
+    loop = GLib.MainLoop()
+
+    def done():
+        print_report(sink.report())
+        sink.close()
+        loop.quit()
+
+    GLib.timeout_add_seconds(args.duration, done)
+    loop.run()
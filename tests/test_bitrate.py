@@ -0,0 +1,84 @@
+import unittest
+
+from bitrate import BitrateController
+
+
+class BitrateControllerTest(unittest.TestCase):
+    MAX = 10000
+
+    def setUp(self):
+        self.set_calls = []
+        self.controller = BitrateController(self.MAX, self.set_calls.append)
+
+    def good(self, n=1):
+        for _ in range(n):
+            self.controller.update(0.0, 0.001, 0.01)
+
+    def test_decrease_on_loss(self):
+        self.controller.update(0.05, 0.001, 0.01)
+        self.assertEqual(self.controller.bitrate, int(self.MAX * BitrateController.DECREASE))
+        self.assertEqual(self.set_calls, [self.controller.bitrate])
+
+    def test_decrease_on_rtt(self):
+        self.controller.update(0.0, 0.001, BitrateController.RTT_HIGH * 2)
+        self.assertEqual(self.controller.bitrate, int(self.MAX * BitrateController.DECREASE))
+
+    def test_hysteresis_band_keeps_bitrate(self):
+        self.controller.update(0.05, 0.001, 0.01)
+        bitrate = self.controller.bitrate
+
+        loss = (BitrateController.LOSS_LOW + BitrateController.LOSS_HIGH) / 2
+        for _ in range(BitrateController.HOLD_REPORTS * 2):
+            self.controller.update(loss, 0.001, 0.01)
+        self.assertEqual(self.controller.bitrate, bitrate)
+        self.assertEqual(len(self.set_calls), 1)
+
+    def test_hysteresis_band_resets_good_reports(self):
+        self.controller.update(0.05, 0.001, 0.01)
+        bitrate = self.controller.bitrate
+
+        self.good(BitrateController.HOLD_REPORTS - 1)
+        self.controller.update(BitrateController.LOSS_LOW, 0.001, 0.01)
+        self.good(BitrateController.HOLD_REPORTS - 1)
+        self.assertEqual(self.controller.bitrate, bitrate)
+
+    def test_increase_after_hold(self):
+        self.controller.update(0.05, 0.001, 0.01)
+        bitrate = self.controller.bitrate
+
+        self.good(BitrateController.HOLD_REPORTS - 1)
+        self.assertEqual(self.controller.bitrate, bitrate)
+        self.good()
+        self.assertEqual(self.controller.bitrate, bitrate + int(self.MAX * BitrateController.INCREASE))
+        self.assertEqual(len(self.set_calls), 2)
+
+    def test_clamp_to_max(self):
+        self.good(BitrateController.HOLD_REPORTS * 3)
+        self.assertEqual(self.controller.bitrate, self.MAX)
+        self.assertEqual(self.set_calls, [])
+
+        self.controller.update(0.05, 0.001, 0.01)
+        self.good(BitrateController.HOLD_REPORTS * 20)
+        self.assertEqual(self.controller.bitrate, self.MAX)
+
+    def test_clamp_to_min(self):
+        for _ in range(50):
+            self.controller.update(0.5, 0.001, 0.01)
+        self.assertEqual(self.controller.bitrate, int(self.MAX * BitrateController.MIN_FRACTION))
+        self.assertEqual(self.set_calls[-1], self.controller.bitrate)
+        self.assertEqual(len(set(self.set_calls)), len(self.set_calls))
+
+    def test_set_limits_keeps_adapted_bitrate(self):
+        self.controller.update(0.05, 0.001, 0.01)
+        bitrate = self.controller.bitrate
+
+        self.controller.set_limits(self.MAX * 2)
+        self.assertEqual(self.controller.bitrate, bitrate)
+        self.controller.set_limits(bitrate // 2)
+        self.assertEqual(self.controller.bitrate, bitrate // 2)
+        self.controller.set_limits(bitrate * 100)
+        self.assertEqual(self.controller.bitrate, bitrate * 100 * BitrateController.MIN_FRACTION)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import shutil
+import subprocess
+import time
+import unittest
+from unittest import mock
+
+try:
+    import capture
+    from gi.repository import Gst
+except (ImportError, ValueError):
+    capture = None
+else:
+    Gst.init(None)
+
+
+def have_element(name):
+    return capture is not None and Gst.ElementFactory.find(name) is not None
+
+
+@unittest.skipUnless(capture, 'needs GStreamer (gi) and dbus')
+class SelectionTest(unittest.TestCase):
+    def setUp(self):
+        for patcher in (mock.patch.object(capture.XImageCaptureSource, 'DISPLAY', None),
+                        mock.patch.object(capture.PipeWireCaptureSource, 'PORTAL', None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def select(self, preference, display=None):
+        env = {k: v for k, v in os.environ.items() if k != 'DISPLAY'}
+        if display is not None:
+            env['DISPLAY'] = display
+        with mock.patch.dict(os.environ, env, clear=True):
+            return capture.make_capture_source(preference)
+
+    @unittest.skipUnless(have_element('videotestsrc'), 'needs videotestsrc')
+    def test_pipewire_needs_portal(self):
+        source = self.select(['pipewire', 'test'])
+        self.assertIsInstance(source, capture.TestCaptureSource)
+
+    @unittest.skipUnless(have_element('videotestsrc'), 'needs videotestsrc')
+    def test_ximage_needs_display(self):
+        source = self.select(['ximage', 'test'])
+        self.assertIsInstance(source, capture.TestCaptureSource)
+
+    @unittest.skipUnless(have_element('ximagesrc'), 'needs ximagesrc')
+    def test_ximage_with_display(self):
+        source = self.select(['pipewire', 'ximage', 'test'], display=':0')
+        self.assertIsInstance(source, capture.XImageCaptureSource)
+
+    @unittest.skipUnless(have_element('videotestsrc'), 'needs videotestsrc')
+    def test_unknown_skipped(self):
+        source = self.select(['vnc', 'test'])
+        self.assertIsInstance(source, capture.TestCaptureSource)
+
+    def test_nothing_available(self):
+        with self.assertRaises(AssertionError):
+            self.select(['vnc', 'pipewire'])
+
+
+@unittest.skipUnless(have_element('ximagesrc') and have_element('fakesink'), 'needs ximagesrc')
+@unittest.skipUnless(shutil.which('Xvfb'), 'needs Xvfb')
+class XvfbCaptureTest(unittest.TestCase):
+    DISPLAY = ':87'
+    FRAMES = 5
+
+    @classmethod
+    def setUpClass(cls):
+        cls.xvfb = subprocess.Popen(['Xvfb', cls.DISPLAY, '-screen', '0', '640x480x24', '-nolisten', 'tcp'],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        socket = '/tmp/.X11-unix/X%s' % cls.DISPLAY[1:]
+        deadline = time.monotonic() + 5
+        while not os.path.exists(socket):
+            if cls.xvfb.poll() is not None or time.monotonic() > deadline:
+                cls.tearDownClass()
+                raise unittest.SkipTest('Xvfb did not start')
+            time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.xvfb.terminate()
+        cls.xvfb.wait()
+
+    def test_capture(self):
+        with mock.patch.object(capture.XImageCaptureSource, 'DISPLAY', self.DISPLAY):
+            source = capture.make_capture_source(['ximage'])
+            pipeline = Gst.Pipeline()
+            element = source.build(pipeline)
+        element.props.num_buffers = self.FRAMES
+        sink = Gst.ElementFactory.make('fakesink')
+        pipeline.add(sink)
+        element.link(sink)
+
+        pipeline.set_state(Gst.State.PLAYING)
+        try:
+            msg = pipeline.get_bus().timed_pop_filtered(10 * Gst.SECOND,
+                                                        Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        finally:
+            pipeline.set_state(Gst.State.NULL)
+
+        self.assertIsNotNone(msg)
+        self.assertEqual(msg.type, Gst.MessageType.EOS)
+        stats = source.stats()
+        self.assertEqual(stats['source'], 'ximage')
+        self.assertEqual(stats['frames'], self.FRAMES)
+        # ximagesrc cannot tell unchanged frames apart
+        self.assertEqual(stats['unchanged-frames'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import struct
+import unittest
+
+from edid import EDID, DetailedTiming
+
+
+def detailed_timing(width, height, hblank, vblank, pixel_clock, interlaced=False):
+    return (struct.pack('<H', pixel_clock // 10000)
+            + bytes([width & 0xff, hblank & 0xff, (width >> 8) << 4 | hblank >> 8,
+                     height & 0xff, vblank & 0xff, (height >> 8) << 4 | vblank >> 8])
+            + bytes(9) + bytes([0x80 if interlaced else 0x00]))
+
+
+def make_edid(timings, name=b'TEST TV'):
+    data = bytearray(128)
+    data[0:8] = EDID.HEADER
+    # "ABC", product 0x1234, serial 1
+    data[8:10] = struct.pack('>H', 1 << 10 | 2 << 5 | 3)
+    data[10:16] = struct.pack('<HI', 0x1234, 1)
+    data[18:20] = bytes([1, 4])
+
+    descriptors = list(timings)
+    descriptors.append(b'\x00\x00\x00\xfc\x00' + (name + b'\n').ljust(13, b' '))
+    for i, descr in enumerate(descriptors):
+        data[54 + 18 * i:72 + 18 * i] = descr
+
+    data[127] = -sum(data[:127]) & 0xff
+    return bytes(data)
+
+
+class EDIDTest(unittest.TestCase):
+    def test_parse(self):
+        edid = EDID(make_edid([detailed_timing(1920, 1080, 280, 45, 148500000)]))
+        self.assertEqual(edid.manufacturer, 'ABC')
+        self.assertEqual(edid.product, 0x1234)
+        self.assertEqual(edid.version, (1, 4))
+        self.assertEqual(edid.name, 'TEST TV')
+        self.assertEqual((edid.preferred.width, edid.preferred.height), (1920, 1080))
+        self.assertAlmostEqual(edid.preferred.refresh, 60, places=1)
+        self.assertFalse(edid.preferred.interlaced)
+
+    def test_interlaced(self):
+        timing = DetailedTiming(detailed_timing(1920, 540, 280, 22, 74250000, interlaced=True))
+        self.assertEqual(timing.height, 1080)
+        self.assertTrue(timing.interlaced)
+        self.assertAlmostEqual(timing.refresh, 60, delta=0.2)
+
+    def test_no_timings(self):
+        self.assertIsNone(EDID(make_edid([])).preferred)
+
+    def test_not_an_edid(self):
+        with self.assertRaises(ValueError):
+            EDID(bytes(128))
+        with self.assertRaises(ValueError):
+            EDID(EDID.HEADER)
+
+    def test_empty_timing(self):
+        # Pixel clock set, but no size: must not divide by zero
+        with self.assertRaises(ValueError):
+            EDID(make_edid([detailed_timing(0, 0, 0, 0, 10000)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
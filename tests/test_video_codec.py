@@ -0,0 +1,76 @@
+import unittest
+
+from wfdparams import VideoCodec
+
+# 640x480p60, 1280x720p30/p60, 1920x1080p30/p60 and 800x600p60, 800x480p30
+DESCR = '02 04 000001E1 00000002 00000001 00 0000 0000 00 none none'
+
+
+def make_codec(descr=DESCR, native=0):
+    return VideoCodec(native, descr)
+
+
+class VideoCodecTest(unittest.TestCase):
+    def test_modes_mask(self):
+        codec = make_codec()
+        cea, vesa, hh = VideoCodec.TABLE_SHIFT
+        self.assertEqual(codec.modes_mask, 0x1e1 << cea | 0x2 << vesa | 0x1 << hh)
+        self.assertEqual(VideoCodec.MODES[vesa + 1][:4], (800, 600, 60, False))
+
+    def test_modes_mask_ignores_unknown_bits(self):
+        codec = make_codec('01 01 FFFFFFFF 00000000 00000000 00 0000 0000 00 none none')
+        self.assertEqual(codec.modes_mask, (1 << len(VideoCodec.CEA)) - 1)
+
+    def test_best_and_worst_mode(self):
+        codec = make_codec()
+        self.assertEqual(VideoCodec.best_mode(codec.modes_mask)[:4], (1920, 1080, 60, False))
+        self.assertEqual(VideoCodec.worst_mode(codec.modes_mask)[:4], (640, 480, 60, False))
+        self.assertEqual(codec.get_resolutions()[0], VideoCodec.best_mode(codec.modes_mask))
+        self.assertIsNone(VideoCodec.best_mode(0))
+        self.assertIsNone(VideoCodec.worst_mode(0))
+
+    def test_link_mask(self):
+        codec = make_codec()
+        # 1080p30 needs ~6.2 Mbit/s, 720p60 ~5.5 Mbit/s at BITS_PER_PIXEL
+        mask = codec.modes_mask & VideoCodec.link_mask(6000)
+        self.assertEqual(VideoCodec.best_mode(mask)[:4], (1280, 720, 60, False))
+        self.assertEqual(codec.modes_mask & VideoCodec.link_mask(100000), codec.modes_mask)
+        self.assertEqual(VideoCodec.link_mask(0), 0)
+
+    def test_link_mask_interlaced(self):
+        # Interlaced modes only need half the throughput
+        progressive = (1920, 1080, 60, False, 0, 8)
+        interlaced = (1920, 1080, 60, True, 0, 9)
+        mask = VideoCodec.link_mask(10000)
+        self.assertFalse(mask >> VideoCodec.mode_bit(progressive) & 1)
+        self.assertTrue(mask >> VideoCodec.mode_bit(interlaced) & 1)
+
+    def test_slices_for(self):
+        vga = (640, 480, 60, False, 0, 0)
+        fullhd = (1920, 1080, 60, False, 0, 8)
+
+        # No slice support
+        self.assertEqual(make_codec().slices_for(fullhd, 4), 1)
+
+        # Up to 8 slices of at least 512 macroblocks
+        codec = make_codec('02 04 000001E1 00000000 00000000 00 0200 0007 00 none none')
+        self.assertEqual(codec.max_slices, 8)
+        self.assertEqual(codec.slices_for(fullhd, 4), 4)
+        self.assertEqual(codec.slices_for(fullhd, 16), 8)
+        # 1200 macroblocks only allow two slices
+        self.assertEqual(codec.slices_for(vga, 4), 2)
+        self.assertEqual(codec.slices_for(vga, 1), 1)
+
+    def test_descr_for_resolution(self):
+        codec = make_codec('02 04 000001E1 00000000 00000000 00 0200 0007 00 none none')
+        mode = codec.find_resolution(1280, 720, 60)
+        # Native mode, preferred display mode and the codec
+        native, preferred, descr = codec.descr_for_resolution(mode, 4).split(maxsplit=2)
+        parsed = VideoCodec(int(native, 16), descr)
+        self.assertEqual(parsed.get_resolutions(), [mode])
+        self.assertEqual(parsed.profile, 'CHP')
+        self.assertEqual(parsed.max_slices, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
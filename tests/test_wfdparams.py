@@ -0,0 +1,156 @@
+import unittest
+
+from wfdparams import WFDParams
+
+from test_edid import detailed_timing, make_edid
+
+M3 = (b'wfd_client_rtp_ports: RTP/AVP/UDP;unicast 1028 0 mode=play\r\n'
+      b'wfd_audio_codecs: LPCM 00000002 00, AAC 00000001 00\r\n'
+      b'wfd_video_formats: 40 00 02 04 0001DEFF 053C7FFF 00000FFF 00 0000 0000 11 none none, '
+      b'01 04 0001DEFF 053C7FFF 00000FFF 00 0000 0000 11 none none\r\n'
+      b'wfd_display_edid: none\r\n'
+      b'wfd_connector_type: 05\r\n'
+      b'wfd_I2C: none\r\n'
+      b'wfd2_buffer_length: 100\r\n'
+      b'wfd_3d_video_formats: none\r\n')
+
+
+class ParseBodyTest(unittest.TestCase):
+    def test_parse(self):
+        params = WFDParams.parse_body(b'wfd_audio_codecs: AAC 00000001 00\r\n'
+                                      b'wfd_idr_request\r\n'
+                                      b'\r\n'
+                                      b'wfd_presentation_URL: rtsp://1.2.3.4/wfd1.0/streamid=0 none\r\n\x00')
+        self.assertEqual(params, {
+            'wfd_audio_codecs': 'AAC 00000001 00',
+            'wfd_idr_request': None,
+            # Only split at the first colon
+            'wfd_presentation_URL': 'rtsp://1.2.3.4/wfd1.0/streamid=0 none',
+        })
+
+    def test_lf_only(self):
+        self.assertEqual(WFDParams.parse_body(b'a: 1\nb:2\n'), {'a': '1', 'b': '2'})
+
+    def test_empty(self):
+        self.assertEqual(WFDParams.parse_body(b''), {})
+
+
+class UpdateTest(unittest.TestCase):
+    def parse(self, body):
+        params = WFDParams()
+        params.from_sink(body)
+        return params
+
+    def test_m3(self):
+        params = self.parse(M3)
+        self.assertEqual(params.profile, 'RTP/AVP/UDP;unicast')
+        self.assertEqual(params.primary_rtp_port, 1028)
+        self.assertEqual([c.profile for c in params.video_codecs], ['CHP', 'CBP'])
+        self.assertEqual(params.video_codecs[0].get_native_resolution()[:2], (1920, 1080))
+        self.assertTrue(params.video_codecs[0].frame_skipping_allowed)
+        self.assertEqual([c.format for c in params.audio_codecs], ['LPCM', 'AAC'])
+        self.assertIsNone(params.edid)
+        self.assertEqual(params.connector_type, 5)
+        self.assertIsNone(params.i2c_port)
+        self.assertEqual(params.buffer_length, 100)
+        self.assertEqual(params.other, {'wfd_3d_video_formats': None})
+
+    def test_sink_actions_ignored(self):
+        params = WFDParams()
+        params.update({'wfd_idr_request': None, 'wfd_trigger_method': 'TEARDOWN'})
+        self.assertEqual(params.other, {})
+
+    def test_i2c(self):
+        self.assertEqual(self.parse(b'wfd_I2C: 8080\r\n').i2c_port, 8080)
+        # Not decimal, must not break M3 handling
+        self.assertIsNone(self.parse(b'wfd_I2C: 1F90\r\n').i2c_port)
+
+    def test_malformed_optional_fields(self):
+        params = self.parse(b'wfd2_buffer_length: lots\r\n'
+                            b'wfd_connector_type: HDMI\r\n'
+                            b'wfd_audio_codecs: MP3 00000001 00, AAC 00000001 00\r\n')
+        self.assertIsNone(params.buffer_length)
+        self.assertIsNone(params.connector_type)
+        self.assertEqual([c.format for c in params.audio_codecs], ['AAC'])
+
+    def test_edid(self):
+        edid = make_edid([detailed_timing(1920, 1080, 280, 45, 148500000)])
+        params = self.parse(b'wfd_display_edid: 0001 ' + edid.hex().encode('ascii') + b'\r\n')
+        self.assertEqual(params.edid, edid)
+        self.assertEqual((params.native_timing().width, params.native_timing().height), (1920, 1080))
+
+    def test_edid_without_data(self):
+        params = self.parse(b'wfd_display_edid: 0000 none\r\n')
+        self.assertIsNone(params.edid)
+        self.assertIsNone(params.native_timing())
+
+    def test_malformed_edid(self):
+        bad = [
+            b'wfd_display_edid: 0001\r\n',
+            b'wfd_display_edid: x 00\r\n',
+            b'wfd_display_edid: 0001 zz\r\n',
+            b'wfd_display_edid: 0001 00ffffffffffff00\r\n',
+            b'wfd_display_edid: 0001 ' + make_edid([detailed_timing(0, 0, 0, 0, 10000)]).hex().encode('ascii') + b'\r\n',
+        ]
+        for body in bad:
+            with self.subTest(body=body):
+                params = self.parse(body)
+                self.assertIsNone(params.edid_info)
+                self.assertIsNone(params.native_timing())
+
+
+class MediaKeyTest(unittest.TestCase):
+    """Sinks with the same media key share one WFDMedia"""
+
+    def select(self, body=M3, codec=1, resolution=(1280, 720, 30, False), encoder='x264', slices=1, audio=1):
+        params = WFDParams()
+        params.from_sink(body)
+        # Set what WFDMedia.wfd_select_codecs() would pick
+        params.selected_codec = params.video_codecs[codec]
+        params.selected_resolution = resolution
+        params.selected_encoder = encoder
+        params.selected_slices = slices
+        if audio is None:
+            params.selected_audio_codec = params.selected_audio_mode = None
+        else:
+            params.selected_audio_codec = params.audio_codecs[audio]
+            params.selected_audio_mode = params.selected_audio_codec.find_mode()
+        return params
+
+    def test_same_selection_shares(self):
+        self.assertEqual(self.select().media_key(), self.select().media_key())
+        # Capabilities beyond the selection do not matter
+        other = M3.replace(b'LPCM 00000002 00, ', b'').replace(b'wfd2_buffer_length: 100', b'wfd2_buffer_length: 200')
+        self.assertEqual(self.select().media_key(), self.select(other, audio=0).media_key())
+
+    def test_differences_split(self):
+        key = self.select().media_key()
+        for name, kwargs in [
+            ('profile', {'codec': 0}),
+            ('resolution', {'resolution': (1920, 1080, 30, False)}),
+            ('interlaced', {'resolution': (1280, 720, 30, True)}),
+            ('encoder', {'encoder': 'openh264'}),
+            ('slices', {'slices': 2}),
+            ('audio', {'audio': 0}),
+            ('no audio', {'audio': None}),
+        ]:
+            with self.subTest(name):
+                self.assertNotEqual(self.select(**kwargs).media_key(), key)
+
+    def test_frame_skipping_splits(self):
+        def frame_rate_ctrl(value):
+            return self.select(M3.replace(b'0000 0000 11 none', b'0000 0000 %s none' % value))
+
+        unlimited = frame_rate_ctrl(b'01')
+        bounded = frame_rate_ctrl(b'09')
+        forbidden = frame_rate_ctrl(b'00')
+        self.assertEqual(unlimited.selected_codec.max_skip_interval(), -1)
+        self.assertEqual(bounded.selected_codec.max_skip_interval(), 2)
+        self.assertEqual(forbidden.selected_codec.max_skip_interval(), 0)
+        self.assertEqual(len({unlimited.media_key(), bounded.media_key(), forbidden.media_key()}), 3)
+        # Bits above the interval field do not change how frames are skipped
+        self.assertEqual(frame_rate_ctrl(b'11').media_key(), unlimited.media_key())
+
+
+if __name__ == '__main__':
+    unittest.main()
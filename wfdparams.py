@@ -0,0 +1,640 @@
+"""Video/audio codecs and capabilities of a sink as exchanged in the WFD
+parameters (M3/M4). Plain Python, used by the RTSP client and the media."""
+
+import struct
+
+from edid import EDID
+
+
+CONNECTOR_TYPE = {
+     0: 'VGA',
+     1: 'S-VIDEO',
+     2: 'Composite Video',
+     3: 'Component Video',
+     4: 'DVI',
+     5: 'HDMI',
+#     6: Reserved,
+     7: 'Wi-Fi Display',
+     8: 'Japanese D',
+     9: 'SDI',
+    10: 'DP',
+#    11: Reserved,
+    12: 'UDI',
+   255: 'Unknown'
+}
+
+
+class VideoCodec:
+    # Video modes: width, height, refresh rate, interlaced
+    CEA = [
+        ( 640,  480, 60, False),
+        ( 720,  480, 60, False),
+        ( 720,  480, 60, True),
+        ( 720,  576, 50, False),
+        ( 720,  576, 50, True),
+        (1280,  720, 30, False),
+        (1280,  720, 60, False),
+        (1920, 1080, 30, False),
+        (1920, 1080, 60, False),
+        (1920, 1080, 60, True),
+        (1290,  720, 25, False),
+        (1280,  720, 50, False),
+        (1920, 1080, 25, False),
+        (1920, 1080, 50, False),
+        (1920, 1080, 50, True),
+        (1280,  720, 24, False),
+        (1920, 1080, 25, False),
+    ]
+
+    VESA = [
+        ( 800,  600, 30, False),
+        ( 800,  600, 60, False),
+        (1024,  768, 30, False),
+        (1024,  768, 60, False),
+        (1152,  864, 30, False),
+        (1152,  864, 60, False),
+        (1280,  768, 30, False),
+        (1280,  768, 60, False),
+        (1280,  800, 30, False),
+        (1280,  800, 60, False),
+        (1360,  768, 30, False),
+        (1360,  768, 60, False),
+        (1366,  768, 30, False),
+        (1366,  768, 60, False),
+        (1280, 1024, 30, False),
+        (1280, 1024, 60, False),
+        (1400, 1050, 30, False),
+        (1400, 1050, 60, False),
+        (1440,  900, 30, False),
+        (1440,  900, 60, False),
+        (1600,  900, 30, False),
+        (1600,  900, 60, False),
+        (1600, 1200, 30, False),
+        (1600, 1200, 60, False),
+        (1680, 1024, 30, False),
+        (1680, 1024, 30, False),
+        (1680, 1050, 30, False),
+        (1680, 1050, 60, False),
+        (1920, 1200, 30, False),
+    ]
+
+    HH = [
+        (800, 480, 30, False),
+        (800, 480, 60, False),
+        (854, 480, 30, False),
+        (854, 480, 60, False),
+        (864, 480, 30, False),
+        (864, 480, 60, False),
+        (640, 360, 30, False),
+        (640, 360, 60, False),
+        (960, 540, 30, False),
+        (960, 540, 60, False),
+        (848, 480, 30, False),
+        (848, 480, 60, False),
+    ]
+
+    # Average bits per pixel a stream needs for good quality, used to check
+    # which modes a link can carry
+    BITS_PER_PIXEL = 0.1
+
+    # All modes of the three tables in one list, indexed by the bit used in
+    # the combined capability mask (see modes_mask). Filled in by
+    # _build_mode_table.
+    MODES = []
+    # Bit offsets of the tables in the combined mask
+    TABLE_SHIFT = (0, len(CEA), len(CEA) + len(VESA))
+    # Bits of MODES from the best to the worst mode
+    MODE_ORDER = []
+    _link_masks = {}
+
+    @classmethod
+    def _build_mode_table(cls):
+        cls.MODES = []
+        for t, table in enumerate((cls.CEA, cls.VESA, cls.HH)):
+            for i, mode in enumerate(table):
+                cls.MODES.append((*mode, t, i))
+
+        # Consider interlaced just under half the technical refresh rate
+        key = lambda x: (x[0] * x[1] * 100) + (x[2] / (int(x[3]) + 1) - int(x[3]))
+        cls.MODE_ORDER = sorted(range(len(cls.MODES)), key=lambda b: key(cls.MODES[b]), reverse=True)
+
+    @classmethod
+    def mode_bit(cls, r):
+        return cls.TABLE_SHIFT[r[4]] + r[5]
+
+    @classmethod
+    def best_mode(cls, mask):
+        """Returns the best mode in the given capability mask"""
+        for b in cls.MODE_ORDER:
+            if mask >> b & 1:
+                return cls.MODES[b]
+        return None
+
+    @classmethod
+    def worst_mode(cls, mask):
+        """Returns the least demanding mode in the given capability mask"""
+        for b in reversed(cls.MODE_ORDER):
+            if mask >> b & 1:
+                return cls.MODES[b]
+        return None
+
+    @classmethod
+    def mask_where(cls, predicate):
+        mask = 0
+        for b, r in enumerate(cls.MODES):
+            if predicate(r):
+                mask |= 1 << b
+        return mask
+
+    @classmethod
+    def link_mask(cls, throughput_kbit):
+        """Returns the mask of all modes a link with the given throughput can
+        carry."""
+        if throughput_kbit not in cls._link_masks:
+            # Interlaced modes only transmit half the lines per refresh
+            cls._link_masks[throughput_kbit] = cls.mask_where(
+                lambda r: r[0] * r[1] * r[2] / (int(r[3]) + 1) * cls.BITS_PER_PIXEL / 1000 <= throughput_kbit)
+        return cls._link_masks[throughput_kbit]
+
+    def __init__(self, native, descr):
+        descr = descr.split()
+        assert len(descr) == 11
+
+        self.native = None
+        try:
+            t = native & 0x7
+            i = native >> 3
+            if t == 0x0:
+                self.native = (*self.CEA[native >> 3], t, i)
+            elif t == 0x1:
+                self.native = (*self.VESA[native >> 3], t, i)
+            elif t == 0x2:
+                self.native = (*self.HH[native >> 3], t, i)
+        except IndexError:
+            print('ERROR: Native resolution with ID %02X does not exist' % native)
+            self.native = None
+
+        self._profile = int(descr[0], 16)
+        assert 0 <= self._profile <= 255
+
+        self.level = int(descr[1], 16)
+        assert 0 <= self.level <= 255
+
+        self.cea_sup = int(descr[2], 16)
+        self.vesa_sup = int(descr[3], 16)
+        self.hh_sup = int(descr[4], 16)
+
+        self.modes_mask = 0
+        for t, (bitfield, table) in enumerate(((self.cea_sup, self.CEA),
+                                               (self.vesa_sup, self.VESA),
+                                               (self.hh_sup, self.HH))):
+            self.modes_mask |= (bitfield & ((1 << len(table)) - 1)) << self.TABLE_SHIFT[t]
+        self._resolutions = [self.MODES[b] for b in self.MODE_ORDER if self.modes_mask >> b & 1]
+
+        self.latency = int(descr[5], 16)
+
+        self.min_slice_size = int(descr[6], 16)
+        self.slice_enc_params = int(descr[7], 16)
+        self.frame_rate_ctrl_sup = int(descr[8], 16)
+
+        # We don't support this protocol, so ignore it
+        #self.max_hres = int(descr[9], 16) if descr[9] != 'none' else None
+        #self.max_vres = int(descr[10], 16) if descr[10] != 'none' else None
+
+    @property
+    def num_slices(self):
+        return self.max_slices
+
+    def get_profile(self):
+        if self._profile == 0x01:
+            return 'CBP'
+        elif self._profile == 0x02:
+            return 'CHP'
+        else:
+            raise AssertionError('Unknown profile %02X' % self._profile)
+
+    def set_profile(self, value):
+        if value == 'CBP':
+            self._profile = 0x01
+        elif value == 'CHP':
+            self._profile = 0x02
+        else:
+            raise AssertionError('Unknown profile %s' % value)
+
+    profile = property(get_profile, set_profile)
+
+    @property
+    def max_vcl_bitrate_kbit(self):
+        if self.level == 1 << 0:
+            # 3.1
+            bitrate = 14000
+        elif self.level == 1 << 1:
+            # 3.2
+            bitrate = 20000
+        elif self.level == 1 << 2:
+            # 4
+            bitrate = 20000
+        elif self.level == 1 << 3:
+            # 4.1
+            bitrate = 50000
+        elif self.level == 1 << 4:
+            # 4.2
+            bitrate = 50000
+
+        if self.profile == 'CHP':
+            bitrate = int(bitrate * 1.25)
+
+        return bitrate
+
+    @property
+    def max_slices(self):
+        # A min-slice-size of zero means slices are not supported
+        if self.min_slice_size == 0:
+            return 1
+        return (self.slice_enc_params & 0x3ff) + 1
+
+    def slices_for(self, r, wanted):
+        """Returns the number of slices closest to wanted that the sink
+        supports for resolution r. min_slice_size is in macroblocks."""
+        slices = min(wanted, self.max_slices)
+        if slices > 1:
+            macroblocks = ((r[0] + 15) // 16) * ((r[1] + 15) // 16)
+            slices = min(slices, macroblocks // self.min_slice_size)
+        return max(1, slices)
+
+    def get_frame_skipping_allowed(self):
+        return bool(self.frame_rate_ctrl_sup & 0x1)
+
+    def set_frame_skipping_allowed(self, value):
+        self.frame_rate_ctrl_sup = (self.frame_rate_ctrl_sup & 0xfffe) | int(bool(value))
+
+    frame_skipping_allowed = property(get_frame_skipping_allowed, set_frame_skipping_allowed)
+
+    def max_skip_interval(self):
+        """Returns the maximum time that may be skipped. Returns -1 if there
+        are no time constraints."""
+        if not self.frame_skipping_allowed:
+            return 0
+        skip = (self.frame_rate_ctrl_sup >> 1) & 0x7
+        if skip == 0:
+            return -1
+        return skip * 0.5
+
+    def get_resolutions(self):
+        # Precomputed from the capability mask, sorted from best to worst
+        return self._resolutions
+
+    def get_native_resolution(self):
+        return self.native
+
+    def find_best_resolution(self):
+        return self.get_resolutions()[0]
+
+    def find_resolution(self, width, height, framerate=None, interlaced=None):
+        resolutions = self.get_resolutions()
+
+        for r in resolutions:
+            if r[0] != width or r[1] != height:
+                continue
+            if framerate is not None and r[2] != framerate:
+                continue
+            if interlaced is not None and r[3] != interlaced:
+                continue
+            return r
+
+        return None
+
+    def descr_for_resolution(self, r, slices=1):
+        # We only support base profile
+        profile = self._profile
+        level = self.level
+
+        sup = 1 << r[5]
+        cea_sup = sup if r[4] == 0 else 0
+        vesa_sup = sup if r[4] == 1 else 0
+        hh_sup = sup if r[4] == 2 else 0
+
+        latency = 0
+
+        min_slice_size = 0
+        slice_enc_params = 0
+        if slices > 1:
+            min_slice_size = self.min_slice_size
+            slice_enc_params = (self.slice_enc_params & 0x1c00) | (slices - 1)
+        # Frame skipping with the max skip interval of the sink, see
+        # capture.FrameSkipper. Dynamic framerate changes are not supported.
+        frame_rate_ctrl_sup = self.frame_rate_ctrl_sup & 0x0f if self.frame_skipping_allowed else 0x00
+
+        return "00 00 %02X %02X %08X %08X %08X %02X %04X %04X %02x none none" % (
+                # static: native resolution and prefered display mode
+                profile, level,
+                cea_sup, vesa_sup, hh_sup,
+                latency, min_slice_size, slice_enc_params, frame_rate_ctrl_sup
+                # static: maximum width and height
+            )
+
+VideoCodec._build_mode_table()
+
+
+class AudioCodec:
+    # Audio modes: sample rate, bits per sample, channels
+    MODES = {
+        'LPCM': [
+            (44100, 16, 2),
+            (48000, 16, 2),
+        ],
+        'AAC': [
+            (48000, 16, 2),
+            (48000, 16, 4),
+            (48000, 16, 6),
+            (48000, 16, 8),
+        ],
+        'AC3': [
+            (48000, 16, 2),
+            (48000, 16, 4),
+            (48000, 16, 6),
+        ],
+    }
+
+    def __init__(self, descr):
+        descr = descr.split()
+        assert len(descr) == 3
+
+        self.format = descr[0]
+        assert self.format in self.MODES
+
+        self.modes = int(descr[1], 16)
+        self.latency = int(descr[2], 16)
+
+    def get_modes(self):
+        modes = []
+        mapping = self.MODES[self.format]
+        for i in range(len(mapping)):
+            if self.modes & (1 << i):
+                modes.append((*mapping[i], i))
+
+        return modes
+
+    def find_mode(self, rate=None, channels=None):
+        for m in self.get_modes():
+            if rate is not None and m[0] != rate:
+                continue
+            if channels is not None and m[2] != channels:
+                continue
+            return m
+
+        return None
+
+    def descr_for_mode(self, m):
+        return "%s %08X 00" % (self.format, 1 << m[3])
+
+
+class WFDParams:
+    # Mandatory at connection time:
+    #  * wfd_client_rtp_ports
+    #  * 
+    m3_mandatory = [
+        b'wfd_client_rtp_ports',
+        b'wfd_audio_codecs',
+        b'wfd_video_formats',
+
+        # Only if supported:
+        #b'wfd_content_protection',
+    ]
+
+    m3_optional = [
+        b'wfd_3d_video_formats',
+        b'wfd_display_edid',
+        b'wfd_coupled_sink',
+        b'wfd_I2C',
+        b'wfd_standby_resume_capability',
+        b'wfd_connector_type',
+        b'wfd_uibc_capability',
+        b'wfd2_audio_codecs',
+        b'wfd2_video_codecs',
+        b'wfd2_aux_stream_formats',
+        b'wfd2_buffer_length',
+        b'wfd2_audio_playback_status',
+        b'wfd2_video_playback_status',
+        b'wfd2_cta_datablock_collection',
+    ]
+
+
+    # Parameters the sink sets to trigger an action rather than to report a
+    # capability, these are handled by WFDClient.do_params_set.
+    sink_actions = [
+        'wfd_idr_request',
+        'wfd_standby',
+        'wfd_trigger_method',
+        'wfd_route',
+        'wfd_uibc_setting',
+    ]
+
+    # Optional parameters that are queried in M3, sinks answer "none" for
+    # parameters that they do not support.
+    m3_query_optional = [
+        b'wfd_display_edid',
+        b'wfd_connector_type',
+        b'wfd_coupled_sink',
+        b'wfd_standby_resume_capability',
+        b'wfd_uibc_capability',
+        b'wfd_I2C',
+        b'wfd2_buffer_length',
+    ]
+
+    def __init__(self):
+        self.resolution = (1920, 1080)
+        self.video_codecs = []
+        self.audio_codecs = []
+        self.profile = 'RTP/AVP/UDP;unicast'
+        self.primary_rtp_port = 16384
+        self.secondary_rtp_port = 0
+
+        self.edid = None
+        self.edid_info = None
+        self.connector_type = None
+        self.buffer_length = None
+        self.coupled_sink = None
+        self.standby_resume = False
+        self.uibc_capability = None
+        self.i2c_port = None
+        self.content_protection = None
+        # Reported parameters we do not interpret
+        self.other = {}
+
+        # Add a basic standard codec for testing purposes
+        codec = VideoCodec(0, '01 01 00000081 00000000 00000000 00 0000 0000 00 none none')
+        self.video_codecs.append(codec)
+        self.active_codec = None
+
+    def from_sink(self, body):
+        self.update(self.parse_body(body))
+
+    @staticmethod
+    def parse_body(body):
+        """Split a text/parameters body into a dictionary. Parameters without
+        a value (e.g. wfd_idr_request) map to None."""
+        params = {}
+
+        # Params are separated by CRLF, just split on LF and strip
+        for option in body.strip(b'\x00').split(b'\n'):
+            option = option.decode('ascii')
+            option = option.strip()
+            # Ignore empty lines
+            if not option:
+                continue
+            option = option.split(':', 1)
+            param = option[0].strip()
+            if len(option) != 2:
+                params[param] = None
+            else:
+                params[param] = option[1].strip()
+
+        return params
+
+    def update(self, params):
+        """Update the sink capabilities from parsed parameters, used for both
+        the M3 response and SET_PARAMETER requests from the sink. Parameters
+        that trigger actions are left to the caller."""
+        for param, val in params.items():
+            if val is None or param in self.sink_actions:
+                continue
+
+            if param == 'wfd_client_rtp_ports':
+                val = val.split()
+                assert len(val) == 4
+                self.profile = val[0]
+                assert self.profile in ('RTP/AVP/UDP;unicast', 'RTP/AVP/TCP;unicast')
+
+                self.primary_rtp_port = int(val[1])
+                self.secondary_rtp_port = int(val[2])
+
+                assert val[3] == 'mode=play'
+            elif param == 'wfd_video_formats':
+                self.video_codecs = []
+                if val == 'none':
+                    continue
+
+                val = val.split(maxsplit=2)
+                assert len(val) == 3
+                native = int(val[0], 16)
+                # Prefered display mode is a V1.0 only specification to
+                # figure out a good mode. However, we can just select something
+                # sane without it.
+                video_prefered_display_mode_supported = int(val[1], 16)
+                # CAE: 0, VESA: 1, HH: 2
+                assert native & 0x7 in [0x0, 0x1, 0x2]
+                assert video_prefered_display_mode_supported in [0x0, 0x1]
+
+                for c in val[2].split(','):
+                    self.video_codecs.append(VideoCodec(native, c))
+            elif param == 'wfd_audio_codecs':
+                self.audio_codecs = []
+                if val == 'none':
+                    continue
+
+                for c in val.split(','):
+                    try:
+                        self.audio_codecs.append(AudioCodec(c))
+                    except (AssertionError, ValueError):
+                        print('WARNING: Ignoring unknown audio codec %s' % c.strip())
+            elif param == 'wfd_display_edid':
+                self._parse_edid(val)
+            elif param == 'wfd_connector_type':
+                self.connector_type = None
+                if val == 'none':
+                    continue
+                try:
+                    connector = int(val, 16)
+                except ValueError:
+                    print('ERROR: Could not parse connector %s' % val)
+                    continue
+                if not connector in CONNECTOR_TYPE:
+                    print('ERROR: Connector %02X reported by sink is not known' % connector)
+                else:
+                    print('INFO: Sink is reporting connector of type %s' % CONNECTOR_TYPE[connector])
+                self.connector_type = connector
+            elif param == 'wfd2_buffer_length':
+                # Size of the sink buffer in ms
+                try:
+                    self.buffer_length = int(val) if val != 'none' else None
+                except ValueError:
+                    print('ERROR: Could not parse buffer length %s' % val)
+                    self.buffer_length = None
+            elif param == 'wfd_coupled_sink':
+                self.coupled_sink = None if val == 'none' else val.split()
+            elif param == 'wfd_standby_resume_capability':
+                self.standby_resume = val == 'supported'
+            elif param == 'wfd_uibc_capability':
+                self.uibc_capability = None if val == 'none' else val
+            elif param == 'wfd_I2C':
+                try:
+                    self.i2c_port = int(val) if val != 'none' else None
+                except ValueError:
+                    print('ERROR: Could not parse I2C port %s' % val)
+                    self.i2c_port = None
+            elif param == 'wfd_content_protection':
+                self.content_protection = None if val == 'none' else val
+            else:
+                # Not interpreted (yet), e.g. wfd_3d_video_formats
+                self.other[param] = None if val == 'none' else val
+
+    def _parse_edid(self, val):
+        self.edid = None
+        self.edid_info = None
+        if val == 'none':
+            # No edid (and reporting not supported)
+            return
+
+        try:
+            length, edid = val.split(maxsplit=1)
+            edid = edid.strip()
+            length = int(length)
+        except ValueError:
+            print("ERROR: Could not parse EDID length")
+            return
+
+        if length == 0 and edid != "none":
+            print('ERROR: EDID must have a value of "none" if length is zero')
+
+        if edid == 'none':
+            # No edid but reporting is supported
+            return
+
+        if len(edid) != 128 * 2 * length:
+            print('ERROR: EDID hex string should be %d characters but is %d characters' % (128 * 2 * length, len(edid)))
+
+        # Sinks send all kinds of broken EDIDs, none of it may break the M3
+        # response handling.
+        try:
+            self.edid = bytes.fromhex(edid)
+            self.edid_info = EDID(self.edid)
+            print('INFO: Sink EDID:', self.edid_info)
+        except (ValueError, ArithmeticError, IndexError, struct.error) as e:
+            print('ERROR: Could not parse EDID: %s' % e)
+
+    def native_timing(self):
+        """Returns the preferred timing of the display, if known"""
+        if self.edid_info is None:
+            return None
+        return self.edid_info.preferred
+
+    def media_key(self):
+        """Returns a string identifying the encoded stream for the selected
+        codecs, see WFDMedia.wfd_media_key()"""
+        codec = self.selected_codec
+        r = self.selected_resolution
+        # The max skip interval decides which frames the FrameSkipper drops,
+        # 0 if the sink does not allow skipping
+        key = '%s:%s:%02X:%dx%d@%d%s:%d:skip%g' % (self.selected_encoder, codec.profile, codec.level,
+                                                  r[0], r[1], r[2], 'i' if r[3] else 'p',
+                                                  self.selected_slices, codec.max_skip_interval())
+        if self.selected_audio_codec is not None:
+            key += ':%s' % self.selected_audio_codec.descr_for_mode(self.selected_audio_mode)
+        return key
+
+    def m3_query_params(self):
+        params = self.m3_mandatory[:]
+        params.extend(self.m3_query_optional)
+
+        return b'\r\n'.join(params) + b'\r\n'